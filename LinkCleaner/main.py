@@ -1,69 +1,1211 @@
 ###############
 ### IMPORTS ###
 ###############
+import time
+# Startup is timed from here, before the slower imports
+bootTime = time.monotonic()
 import discord
-import requests
-import ffmpeg # You might need to manually install ffmpeg, pip didn't properly install it
+import aiohttp
 import os
 import re
-import typing
 import functools
 import asyncio
-from yt_dlp import YoutubeDL
+import sqlite3
+import ipaddress
+import types
+import json
+import hashlib
+import shutil
+import threading
+import tempfile
+import subprocess
+import multiprocessing
+import io
+import errno
+import uuid
+import bisect
+import contextlib
+import sys
+import socket
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_EXCEPTION
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from discord import app_commands, Intents, Client, Interaction, Webhook, Permissions
 from discord.ext import commands
 from discord.utils import get
 from datetime import datetime
+from collections import OrderedDict, deque
+from urllib.parse import urljoin, urlsplit
 from sanitizr.sanitizr import URLCleaner
 from async_timeout import timeout
+from aiohttp import web
 
 #################
 ### VARIABLES ###
 #################
 
-# Discord bot values
-intents = discord.Intents.all()
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
-
 # Dictionaries
-webhooks = {}
+hostSemaphores = {}
+
+# URL cleaner (stateless, shared between calls)
+urlCleaner = URLCleaner()
+
+# Shared HTTP session (created lazily inside the event loop)
+httpSession = None
+
+# Background tasks
+backgroundTasks = {}
+
+# Video probes currently running, keyed by normalized URL
+inFlightProbes = {}
+
+# Reactions currently being handled, keyed by (message id, emoji)
+reactionJobs = set()
+
+# ffmpeg encodes run in their own processes (created on first use)
+compressionPool = None
+compressionPoolLock = threading.Lock()
+
+# Compression pool processes (spawn) re-import this file only to run encode_video,
+# they skip opening the caches, databases & directories the bot uses
+POOL_PROCESS = multiprocessing.current_process().name != "MainProcess"
+
+# Seconds from startup until the first message was handled
+firstMessageSeconds = None
 
 # Pull Variables:
 TOKEN = os.getenv('TOKEN')
 INVIDIOUS_FQDN = os.getenv('INVIDIOUS_FQDN')
 BLACKLISTED_USERS = os.getenv('BLACKLISTED_USERS').split(" ")
 BLACKLISTED_CHANNELS = os.getenv('BLACKLISTED_CHANNELS').split(" ")
+URL_CACHE_SIZE = int(os.getenv('URL_CACHE_SIZE', 10000))
+URL_CACHE_TTL = int(os.getenv('URL_CACHE_TTL', 86400))
+URL_CACHE_NEGATIVE_TTL = int(os.getenv('URL_CACHE_NEGATIVE_TTL', 300))
+URL_CACHE_DB = os.getenv('URL_CACHE_DB')
+CACHE_STATS_INTERVAL = int(os.getenv('CACHE_STATS_INTERVAL', 3600))
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', 4096))
+VIDEO_PROBE_CACHE_SIZE = int(os.getenv('VIDEO_PROBE_CACHE_SIZE', 5000))
+VIDEO_PROBE_TTL = int(os.getenv('VIDEO_PROBE_TTL', 86400))
+VIDEO_PROBE_NEGATIVE_TTL = int(os.getenv('VIDEO_PROBE_NEGATIVE_TTL', 3600))
+VIDEO_PROBE_CACHE_DB = os.getenv('VIDEO_PROBE_CACHE_DB', 'video_probes.db')
+VIDEO_PROBE_WORKERS = int(os.getenv('VIDEO_PROBE_WORKERS', 4))
+VIDEO_PROBE_TIMEOUT = int(os.getenv('VIDEO_PROBE_TIMEOUT', 20))
+VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', 2))
+VIDEO_JOB_TIMEOUT = int(os.getenv('VIDEO_JOB_TIMEOUT', 120))
+COMPRESS_MODE = os.getenv('COMPRESS_MODE', 'twopass')
+COMPRESS_WORKERS = int(os.getenv('COMPRESS_WORKERS', VIDEO_WORKERS))
+COMPRESS_PRESET = os.getenv('COMPRESS_PRESET', 'veryfast')
+COMPRESS_CRF = int(os.getenv('COMPRESS_CRF', 23))
+COMPRESS_THREADS = int(os.getenv('COMPRESS_THREADS', max(1, (os.cpu_count() or 1) // COMPRESS_WORKERS)))
+COMPRESS_TIMEOUT = int(os.getenv('COMPRESS_TIMEOUT', VIDEO_JOB_TIMEOUT))
+SCRATCH_TMPFS = os.getenv('SCRATCH_TMPFS', 'false').lower() == 'true'
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', "/dev/shm/linkcleaner" if SCRATCH_TMPFS else os.path.join(tempfile.gettempdir(), "linkcleaner"))
+SCRATCH_SIZE_MB = int(os.getenv('SCRATCH_SIZE_MB', 4096))
+SCRATCH_MEMORY_UPLOAD_MB = int(os.getenv('SCRATCH_MEMORY_UPLOAD_MB', 25))
+SCRATCH_SWEEP_INTERVAL = int(os.getenv('SCRATCH_SWEEP_INTERVAL', 600))
+SCRATCH_MAX_AGE = int(os.getenv('SCRATCH_MAX_AGE', 3600))
+VIDEO_CACHE_DIR = os.getenv('VIDEO_CACHE_DIR', 'video_cache')
+VIDEO_CACHE_SIZE_MB = int(os.getenv('VIDEO_CACHE_SIZE_MB', 2048))
+RULES_FILE = os.getenv('RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"))
+RULES_RELOAD_INTERVAL = int(os.getenv('RULES_RELOAD_INTERVAL', 30))
+WEBHOOK_DB = os.getenv('WEBHOOK_DB', 'webhooks.db')
+WEBHOOK_PREWARM = os.getenv('WEBHOOK_PREWARM', 'false').lower() == 'true'
+ACTION_CONCURRENCY = int(os.getenv('ACTION_CONCURRENCY', 8))
+MINIMAL_INTENTS = os.getenv('MINIMAL_INTENTS', 'true').lower() == 'true'
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 250))
+AUTO_SHARD = os.getenv('AUTO_SHARD', 'false').lower() == 'true'
+MEDIA_QUEUE_DB = os.getenv('MEDIA_QUEUE_DB')
+URL_PREFILTER = os.getenv('URL_PREFILTER', 'true').lower() == 'true'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', 'command_hash.json')
+MEDIA_WARMUP = os.getenv('MEDIA_WARMUP', 'true').lower() == 'true'
+
+# Discord bot values
+clientClass = discord.AutoShardedClient if AUTO_SHARD else discord.Client
+if MINIMAL_INTENTS:
+    # Only messages & reactions are needed, members aren't requested or cached
+    intents = discord.Intents(guilds=True, guild_messages=True, dm_messages=True, message_content=True, guild_reactions=True, dm_reactions=True)
+    client = clientClass(intents=intents, member_cache_flags=discord.MemberCacheFlags.none(), max_messages=MESSAGE_CACHE_SIZE, chunk_guilds_at_startup=False)
+else:
+    intents = discord.Intents.all()
+    client = clientClass(intents=intents, max_messages=MESSAGE_CACHE_SIZE)
+tree = app_commands.CommandTree(client)
 
 # Constants
-REDIRECTED_FQDNS = {
-    "twitter.com": "vxtwitter.com",
-    "x.com": "vxtwitter.com",
-    "instagram.com": "kkinstagram.com",
-    "threads.net": "fixthreads.net",
-    "minecraft.fandom.com": "minecraft.wiki",
-    "tiktok.com": "vxtiktok.com"
-}
-AUTO_DOWNLOAD_VIDEO_DOMAINS = ["ifunny","reddit"]
-INVALID_VIDEO_PATHS = ["*.png","*.jpeg","*.avif","*.bmp","*.webp","*.jpg","*jpeg/*","*jpeg%3A*","*jpg/*","*jpg%3A*","*png/*","*png%3A*","*bmp/*","*bmp%3A*","*avif/*","*avif%3A*","*webp/*","*webp%3A*","@jpeg","@png","@bmp","@jpg","emojis/*","*.gif","*.gif?*",]
-IGNORED_CLEAN_DOMAINS = ["discord","discordapp","skribbl"]
-IGNORED_VIDEO_DOMAINS = ["tenor","giphy"]
-IGNORED_REDIRECT_DOMAINS = ["youtu","kkinstagram","rxddit","fixvx"]
-DOMAIN_YDL_OPTS = {
-    "ifunny": {'playlist_index': 1,'postprocessors': [], 'postprocessor_args': {}},
-    "discordapp": {'format': 'bestvideo*+bestaudio*','recode': 'mp4'}
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat")
+REDIRECT_MAX_HOPS = 10
+REDIRECT_HOP_TIMEOUT = 5
+REDIRECT_POOL_SIZE = 100
+REDIRECT_HOST_CONCURRENCY = 4
+REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+REDIRECT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; LinkCleaner/2.0; +https://github.com/Mnky313/Discord_LinkCleaner)"
 }
+# Formats are picked by select_video_format, streams are remuxed into mp4 (no re-encode)
 DEFAULT_YDL_OPTS = {
-    'format': 'bestvideo[ext=mp4]+bestaudio[ext=mp4]/mp4',
-    "postprocessors": [
-        {"key": "FFmpegCopyStream"},
-    ],
-    "postprocessor_args": {
-        "copystream": [
-            "-c:v", "libx264"
-        ],
-    }
+    'merge_output_format': 'mp4'
 }
+# Codecs that can be sent as is, anything else is transcoded to h264
+REMUX_VIDEO_CODECS = ("avc1", "h264")
+REMUX_AUDIO_CODECS = ("mp4a", "aac", "none")
+# Leaves room for container overhead when picking a format that fits
+FORMAT_SIZE_MARGIN = 0.95
+# Leaves room for the rest of the upload when splitting the upload limit between videos
+UPLOAD_LIMIT_MARGIN = 0.97
+# Seconds between media queue checks (gateway waiting on results, idle media workers)
+MEDIA_QUEUE_POLL_INTERVAL = 0.25
+# Upper bounds (seconds) of the stage latency histogram buckets
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Seconds between event loop lag measurements
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+###############
+### CLASSES ###
+###############
+
+CACHE_MISS = object()
+NOT_A_VIDEO = {"isVideo": False, "duration": None, "filesize": None, "format": None}
+# Probes that timed out or hit network/extractor errors, treated as no video but never cached
+PROBE_FAILED = dict(NOT_A_VIDEO, failed=True)
+
+class TTLCache:
+    '''
+    Bounded TTL/LRU cache, values must be JSON serializable
+    Failed lookups are cached for a shorter (negative) TTL
+    Entries are optionally persisted to a SQLite table so the cache survives restarts
+    '''
+    def __init__(self, maxSize, ttl, negativeTTL, dbPath=None, table="cache"):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.table = table
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negativeHits = 0
+        self.evictions = 0
+        self.db = None
+        if dbPath:
+            self.db = sqlite3.connect(dbPath)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS "+table+" (key TEXT PRIMARY KEY, value TEXT, negative INTEGER, expires REAL)")
+            self.db.execute("DELETE FROM "+table+" WHERE expires < ?", (time.time(),))
+            self.db.commit()
+            rows = self.db.execute("SELECT key, value, negative, expires FROM "+table+" ORDER BY expires DESC LIMIT ?", (maxSize,)).fetchall()
+            for key, value, negative, expires in reversed(rows):
+                try:
+                    self.entries[key] = (expires, json.loads(value), bool(negative))
+                except ValueError:
+                    continue
+
+    def get(self, key):
+        '''
+        Returns cached value for key or CACHE_MISS
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return CACHE_MISS
+        expires, value, negative = entry
+        if expires < time.time():
+            self.misses += 1
+            self.delete(key)
+            return CACHE_MISS
+        self.entries.move_to_end(key)
+        if negative:
+            self.negativeHits += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, negative=False):
+        '''
+        Caches value for key, evicting the least recently used entries when full
+        '''
+        expires = time.time() + (self.negativeTTL if negative else self.ttl)
+        self.entries[key] = (expires, value, negative)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            evictedKey, _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            if self.db:
+                self.db.execute("DELETE FROM "+self.table+" WHERE key = ?", (evictedKey,))
+        if self.db:
+            self.db.execute("INSERT OR REPLACE INTO "+self.table+" VALUES (?, ?, ?, ?)", (key, json.dumps(value), int(negative), expires))
+            self.db.commit()
+
+    def clear(self):
+        self.entries.clear()
+        if self.db:
+            self.db.execute("DELETE FROM "+self.table)
+            self.db.commit()
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+        if self.db:
+            self.db.execute("DELETE FROM "+self.table+" WHERE key = ?", (key,))
+            self.db.commit()
+
+    def stats(self):
+        '''
+        Returns hit/miss counters for sizing the cache
+        '''
+        lookups = self.hits + self.negativeHits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxSize": self.maxSize,
+            "hits": self.hits,
+            "negativeHits": self.negativeHits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": (self.hits + self.negativeHits) / lookups if lookups else 0.0
+        }
+
+class ParsedURL:
+    '''
+    Immutable components of a URL, see parse_url
+    Query parameters are only split into a dict when first accessed
+    '''
+    __slots__ = ("scheme", "fqdn", "subdomain", "domain", "tld", "path", "query", "fragment", "_params")
+
+    def __init__(self, scheme, fqdn, subdomain, domain, tld, path, query, fragment):
+        setattr = object.__setattr__
+        setattr(self, "scheme", scheme)
+        setattr(self, "fqdn", fqdn)
+        setattr(self, "subdomain", subdomain)
+        setattr(self, "domain", domain)
+        setattr(self, "tld", tld)
+        setattr(self, "path", path)
+        setattr(self, "query", query)
+        setattr(self, "fragment", fragment)
+        setattr(self, "_params", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ParsedURL is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ParsedURL is immutable")
+
+    def __repr__(self):
+        return "ParsedURL("+", ".join(name+"="+repr(getattr(self, name)) for name in self.__slots__[:-1])+")"
+
+    @property
+    def params(self):
+        if self._params is None:
+            paramsDict = {}
+            if self.query:
+                for param in self.query.split("&"):
+                    if param.count("=") == 1:
+                        key, value = param.split("=")
+                        paramsDict[key] = value
+                    else:
+                        # Malformed params
+                        log_event("WARNING","URL contains malformed parameters")
+            object.__setattr__(self, "_params", types.MappingProxyType(paramsDict))
+        return self._params
+
+class AnalyzedURL:
+    '''
+    A single URL found in a message, along with its cleaned & parsed forms
+    isVideo is None until the URL has been probed
+    '''
+    def __init__(self, rawURL, cleanURL, parsedURL):
+        self.rawURL = rawURL
+        self.cleanURL = cleanURL
+        self.parsedURL = parsedURL
+        self.isVideo = None
+        self.probe = None
+
+class MessageAnalysis:
+    '''
+    Result of analyzing a message once: rewritten content plus every URL it contains
+    newContent is False if cleaning didn't change anything
+    '''
+    def __init__(self, content, newContent, urls):
+        self.content = content
+        self.newContent = newContent
+        self.urls = urls
+
+    async def probe_videos(self):
+        '''
+        Tests each unique URL for video once, results are stored on the URLs
+        '''
+        unprobed = {url.cleanURL: url.parsedURL for url in self.urls if url.isVideo is None and url.parsedURL}
+        probes = dict(zip(unprobed, await asyncio.gather(*[test_url_for_video(cleanURL, parsedURL) for cleanURL, parsedURL in unprobed.items()])))
+        for url in self.urls:
+            if url.isVideo is None:
+                url.probe = probes.get(url.cleanURL, NOT_A_VIDEO)
+                url.isVideo = url.probe["isVideo"]
+        return self
+
+    @property
+    def containsVideos(self):
+        return any(url.isVideo for url in self.urls)
+
+    def video_urls(self, domains=None):
+        '''
+        Returns URLs that are videos, optionally limited to the provided domains
+        '''
+        return [url for url in self.urls if url.isVideo and (domains is None or url.parsedURL.domain in domains)]
+
+    def urls_for_domain(self, domain):
+        return [url for url in self.urls if url.parsedURL and url.parsedURL.domain == domain]
+
+class Rules:
+    '''
+    Domain & path rules loaded from RULES_FILE, compiled into set/dict lookups
+    Path wildcards (* matches anything) are combined into a single regex
+    '''
+    def __init__(self, config, mtime=None):
+        self.mtime = mtime
+        self.redirectedFQDNs = dict(config.get("redirected_fqdns", {}))
+        self.autoDownloadVideoDomains = frozenset(config.get("auto_download_video_domains", []))
+        self.ignoredCleanDomains = frozenset(config.get("ignored_clean_domains", []))
+        self.ignoredVideoDomains = frozenset(config.get("ignored_video_domains", []))
+        self.ignoredRedirectDomains = frozenset(config.get("ignored_redirect_domains", []))
+        self.domainYDLOpts = dict(config.get("domain_ydl_opts", {}))
+        self.shortenerFQDNs = frozenset(config.get("shortener_fqdns", []))
+        self.videoDomains = frozenset(config.get("video_domains", []))
+        self.invalidVideoPathRegex = self.compile_paths(config.get("invalid_video_paths", []))
+        self.videoPathRegex = self.compile_paths(config.get("video_paths", []))
+
+    @staticmethod
+    def compile_paths(paths):
+        if not paths:
+            return None
+        return re.compile("|".join(".*".join(re.escape(part) for part in path.split("*")) for path in paths), re.DOTALL)
+
+    @classmethod
+    def from_file(cls, path):
+        mtime = os.path.getmtime(path)
+        with open(path, encoding="utf-8") as rulesFile:
+            return cls(json.load(rulesFile), mtime)
+
+    @staticmethod
+    def match_fqdn(parsedURL, fqdns):
+        '''
+        Returns the most specific of the URL's fqdn & its parent domains that is in fqdns, or None
+        '''
+        labels = parsedURL.fqdn.split(".")
+        # Try the full fqdn first, stopping at the registrable domain
+        minLabels = len(parsedURL.tld.split("."))+1 if parsedURL.tld else len(labels)
+        for start in range(0, len(labels)-minLabels+1):
+            fqdn = ".".join(labels[start:])
+            if fqdn in fqdns:
+                return fqdn
+        return None
+
+    def redirect_for(self, parsedURL):
+        '''
+        Returns (matched fqdn, replacement fqdn) for the most specific redirect rule matching the URL, or None
+        '''
+        fqdn = self.match_fqdn(parsedURL, self.redirectedFQDNs)
+        if fqdn is None:
+            return None
+        return fqdn, self.redirectedFQDNs[fqdn]
+
+    def needs_redirect_check(self, parsedURL):
+        '''
+        Whether following the URL's redirects could change it (it's on a known shortener whose redirects are used)
+        '''
+        return parsedURL.domain not in self.ignoredRedirectDomains and self.match_fqdn(parsedURL, self.shortenerFQDNs) is not None
+
+    def may_be_video(self, parsedURL):
+        '''
+        Whether the URL could be a video worth probing, decided from the URL alone
+        '''
+        if parsedURL.domain in self.ignoredVideoDomains or self.is_invalid_video_path(parsedURL.path):
+            return False
+        if not URL_PREFILTER:
+            return True
+        return parsedURL.domain in self.videoDomains or (self.videoPathRegex is not None and self.videoPathRegex.fullmatch(parsedURL.path) is not None)
+
+    def is_invalid_video_path(self, path):
+        return self.invalidVideoPathRegex is not None and self.invalidVideoPathRegex.fullmatch(path) is not None
+
+    def ydl_opts_for(self, domain):
+        return self.domainYDLOpts.get(domain, {})
+
+class ScratchFullError(Exception):
+    pass
+
+class ScratchSpace:
+    '''
+    Gives each video job its own temporary directory under root (which can be on tmpfs)
+    Directories no job owns anymore (crashes, failures) are swept, new jobs are rejected once maxBytes are in use
+    Only job directories (JOB_PREFIX) are counted & swept, anything else under root is left alone
+    '''
+    JOB_PREFIX = "job-"
+
+    def __init__(self, root, maxBytes):
+        self.root = root
+        self.maxBytes = maxBytes
+        self.active = set()
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.swept = 0
+
+    def create_job_dir(self):
+        if self.is_full():
+            self.rejected += 1
+            raise ScratchFullError("Scratch space is full ("+str(self.usage())+" bytes used)")
+        os.makedirs(self.root, exist_ok=True)
+        jobDir = tempfile.mkdtemp(prefix=self.JOB_PREFIX, dir=self.root)
+        with self.lock:
+            self.active.add(jobDir)
+        return jobDir
+
+    def hand_off(self, jobDir):
+        '''
+        Stops tracking a directory another process is now responsible for removing
+        It's swept like any other orphan if that never happens
+        '''
+        with self.lock:
+            self.active.discard(jobDir)
+
+    def remove(self, jobDir):
+        with self.lock:
+            self.active.discard(jobDir)
+        shutil.rmtree(jobDir, ignore_errors=True)
+
+    def job_dirs(self):
+        '''
+        Returns the job directories under root
+        '''
+        try:
+            return [entry for entry in os.scandir(self.root) if entry.name.startswith(self.JOB_PREFIX) and entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    def usage(self):
+        '''
+        Returns the number of bytes used by job directories
+        '''
+        used = 0
+        for jobDir in self.job_dirs():
+            for directory, subdirectories, files in os.walk(jobDir.path):
+                for file in files:
+                    try:
+                        used += os.path.getsize(os.path.join(directory, file))
+                    except OSError:
+                        pass
+        return used
+
+    def is_full(self):
+        return self.maxBytes > 0 and self.usage() >= self.maxBytes
+
+    def sweep(self, maxAge):
+        '''
+        Removes job directories that aren't owned by a running job & are older than maxAge seconds
+        '''
+        swept = 0
+        for entry in self.job_dirs():
+            with self.lock:
+                if entry.path in self.active:
+                    continue
+            try:
+                if entry.stat().st_mtime > time.time()-maxAge:
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                swept += 1
+            except OSError:
+                pass
+        self.swept += swept
+        return swept
+
+    def stats(self):
+        return {
+            "activeJobs": len(self.active),
+            "bytes": self.usage(),
+            "maxBytes": self.maxBytes,
+            "rejected": self.rejected,
+            "swept": self.swept
+        }
+
+class VideoResult:
+    '''
+    A finished video, either held in memory (data) or in a scratch job directory (path)
+    '''
+    def __init__(self, name, path=None, data=None):
+        self.name = name
+        self.path = path
+        self.data = data
+
+    def to_file(self):
+        if self.data is not None:
+            return discord.File(io.BytesIO(self.data), filename=self.name)
+        return discord.File(self.path, filename=self.name)
+
+    def discard(self):
+        if self.path:
+            scratchSpace.remove(os.path.dirname(self.path))
+
+class VideoJob:
+    '''
+    A queued/running call to func(*args), shared by every caller that submitted the same key
+    '''
+    def __init__(self, key, guildId, func, args, deadline):
+        self.key = key
+        self.guildId = guildId
+        self.func = func
+        self.args = args
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        # Callers still waiting on the result
+        self.refs = 0
+
+class VideoScheduler:
+    '''
+    Runs video jobs (download + compress) on a fixed number of workers
+    Jobs are queued per guild & guilds are served round robin so one busy guild can't starve the others
+    Identical jobs (same key) that are queued or running are shared, results are discarded once every caller releases them
+    '''
+    def __init__(self, workers, jobTimeout):
+        self.workers = workers
+        self.jobTimeout = jobTimeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="video")
+        self.queues = OrderedDict()
+        self.jobs = {}
+        self.fileRefs = {}
+        self.available = None
+        self.workerTasks = []
+        self.running = 0
+        self.completed = 0
+        self.expired = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def start(self):
+        if not self.workerTasks:
+            self.available = asyncio.Semaphore(0)
+            self.workerTasks = [asyncio.create_task(self.worker()) for i in range(self.workers)]
+
+    async def submit(self, key, guildId, func, *args):
+        '''
+        Queues func(*args) (or joins an identical queued/running job) & waits for its result
+        Raises asyncio.TimeoutError if the job doesn't finish within jobTimeout of this call
+        '''
+        self.start()
+        deadline = time.monotonic()+self.jobTimeout
+        job = self.jobs.get(key)
+        if job is not None and job.deadline <= time.monotonic():
+            # Every caller gave up on it, the worker drops it when it gets to it
+            job = None
+        if job is None:
+            job = VideoJob(key, guildId, func, args, deadline)
+            self.jobs[key] = job
+            self.queues.setdefault(guildId, deque()).append(job)
+            self.available.release()
+        # The job lives as long as its latest caller waits
+        job.deadline = max(job.deadline, deadline)
+        job.refs += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), max(deadline-time.monotonic(), 0))
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if job.future.done() and not job.future.cancelled() and job.future.result():
+                self.release(job.future.result())
+            else:
+                job.refs -= 1
+            raise
+
+    def forget(self, job):
+        # A newer job may have replaced an expired one under the same key
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+    def next_job(self):
+        '''
+        Pops the next job, rotating between guilds
+        '''
+        guildId, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        del self.queues[guildId]
+        if queue:
+            self.queues[guildId] = queue
+        return job
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.available.acquire()
+            job = self.next_job()
+            if time.monotonic() >= job.deadline:
+                # Every caller has already given up on this job
+                self.expired += 1
+                self.forget(job)
+                job.future.cancel()
+                continue
+            wait = time.monotonic()-job.enqueued
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self.executor, job.func, *job.args)
+            except Exception as e:
+                log_event("ERROR","Video job failed: "+str(e))
+                result = False
+            finally:
+                self.running -= 1
+            self.forget(job)
+            self.completed += 1
+            if result:
+                self.fileRefs[result] = self.fileRefs.get(result, 0)+job.refs+1
+                self.release(result)
+            job.future.set_result(result)
+
+    def release(self, result):
+        '''
+        Releases a caller's reference to a VideoResult, discarding it once nobody needs it
+        '''
+        self.fileRefs[result] = self.fileRefs.get(result, 1)-1
+        if self.fileRefs[result] <= 0:
+            del self.fileRefs[result]
+            result.discard()
+
+    def stats(self):
+        started = self.completed+self.running
+        return {
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "queuedGuilds": len(self.queues),
+            "running": self.running,
+            "completed": self.completed,
+            "expired": self.expired,
+            "avgWait": self.totalWait / started if started else 0.0,
+            "maxWait": self.maxWait
+        }
+
+class VideoCache:
+    '''
+    Content addressed disk cache of compressed videos, keyed by canonical URL + target size
+    Least recently used files are evicted once the cache grows past maxBytes (0 disables the cache)
+    Files are written to a temporary name & renamed into place so a partial file is never served
+    The directory can be shared between processes (media workers), misses & eviction go by what's on disk
+    '''
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if maxBytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            with self.lock:
+                self.scan()
+                self.evict()
+
+    def scan(self):
+        '''
+        Rebuilds the index from the directory (least recently used first), including files other processes added
+        Must be called with self.lock held
+        '''
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    # Left over from an interrupted write (recent ones may still be in progress in another process)
+                    if stat.st_mtime < time.time()-3600:
+                        os.remove(entry.path)
+                elif entry.is_file():
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                pass
+        self.entries = OrderedDict((name, size) for mtime, name, size in sorted(files))
+        self.size = sum(self.entries.values())
+
+    @staticmethod
+    def key_for(url, targetSize):
+        return hashlib.sha256((url+"|"+str(targetSize)).encode()).hexdigest()+".mp4"
+
+    def get(self, key):
+        '''
+        Returns the path of the cached video for key, or False on a miss
+        The file can be evicted at any time, link or read it straight away
+        '''
+        if not self.maxBytes:
+            return False
+        cachePath = os.path.join(self.directory, key)
+        try:
+            # Also finds videos other processes cached, the mtime is the shared recency order
+            os.utime(cachePath)
+            size = os.path.getsize(cachePath)
+        except OSError:
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+                self.misses += 1
+            return False
+        with self.lock:
+            self.size += size-self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return cachePath
+
+    def discard(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+
+    def put(self, key, file):
+        '''
+        Adds a copy of file to the cache under key
+        '''
+        if not self.maxBytes:
+            return
+        size = os.path.getsize(file)
+        if size > self.maxBytes:
+            return
+        # The directory is shared with other processes (media workers, possibly in other containers), pids & thread ids aren't unique
+        tmpPath = os.path.join(self.directory, key+"."+uuid.uuid4().hex+".tmp")
+        try:
+            link_or_copy(file, tmpPath)
+            os.replace(tmpPath, os.path.join(self.directory, key))
+        finally:
+            # Renaming a link over another link to the same file leaves both in place
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmpPath)
+        with self.lock:
+            # Other processes may have added files since, the budget covers the whole directory
+            self.scan()
+            self.evict()
+
+    def evict(self):
+        # Must be called with self.lock held
+        while self.size > self.maxBytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits+self.misses
+        return {
+            "files": len(self.entries),
+            "bytes": self.size,
+            "maxBytes": self.maxBytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups else 0.0
+        }
+
+class WebhookRegistry:
+    '''
+    One reusable webhook per channel, persisted to SQLite so restarts don't recreate them
+    Lookups are serialized per channel so concurrent messages can't race each other into creating (or deleting) webhooks
+    Stored webhooks are trusted until Discord returns a 404 for them
+    '''
+    def __init__(self, name, dbPath=None):
+        self.name = name
+        self.webhooks = {}
+        self.stored = {}
+        self.locks = {}
+        self.created = 0
+        self.reused = 0
+        self.invalidated = 0
+        self.db = None
+        if dbPath:
+            self.db = sqlite3.connect(dbPath)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS webhooks (channel INTEGER PRIMARY KEY, id INTEGER, token TEXT)")
+            for channelId, webhookId, token in self.db.execute("SELECT channel, id, token FROM webhooks"):
+                self.stored[channelId] = (webhookId, token)
+
+    def webhook_ids(self):
+        return [webhookId for webhookId, token in self.stored.values()]
+
+    async def get(self, channel):
+        '''
+        Returns the webhook for channel, reusing a stored or existing one before creating a new one
+        Raises AttributeError for channels without webhooks (DMs)
+        '''
+        webhook = self.webhooks.get(channel.id)
+        if webhook:
+            return webhook
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            webhook = self.webhooks.get(channel.id)
+            if webhook:
+                return webhook
+            if channel.id in self.stored:
+                webhookId, token = self.stored[channel.id]
+                webhook = Webhook.partial(webhookId, token, client=client)
+            else:
+                webhook = await self.find_or_create(channel)
+            self.webhooks[channel.id] = webhook
+            return webhook
+
+    async def find_or_create(self, channel):
+        for webhook in await channel.webhooks():
+            # Only webhooks created by this bot come with a token
+            if webhook.name == self.name and webhook.token:
+                self.reused += 1
+                self.store(channel.id, webhook)
+                return webhook
+        webhook = await channel.create_webhook(name=self.name)
+        self.created += 1
+        self.store(channel.id, webhook)
+        return webhook
+
+    def store(self, channelId, webhook):
+        self.stored[channelId] = (webhook.id, webhook.token)
+        if str(webhook.id) not in BLACKLISTED_USERS:
+            BLACKLISTED_USERS.append(str(webhook.id))
+        if self.db:
+            self.db.execute("INSERT OR REPLACE INTO webhooks VALUES (?, ?, ?)", (channelId, webhook.id, webhook.token))
+            self.db.commit()
+
+    def invalidate(self, channelId, webhook):
+        '''
+        Forgets a webhook Discord no longer knows about, the next get() finds or creates a replacement
+        '''
+        if self.stored.get(channelId, (None,))[0] != webhook.id:
+            # Already replaced by another message
+            return
+        self.invalidated += 1
+        self.webhooks.pop(channelId, None)
+        del self.stored[channelId]
+        if self.db:
+            self.db.execute("DELETE FROM webhooks WHERE channel = ?", (channelId,))
+            self.db.commit()
+
+    async def prewarm(self):
+        '''
+        Checks every stored webhook still exists, replacing deleted ones before a message needs them
+        '''
+        for channelId in list(self.stored):
+            channel = client.get_channel(channelId)
+            if channel is None:
+                continue
+            webhook = await self.get(channel)
+            try:
+                await webhook.fetch()
+            except discord.NotFound:
+                self.invalidate(channelId, webhook)
+                try:
+                    await self.get(channel)
+                except discord.HTTPException as e:
+                    log_event("WARNING","Couldn't recreate webhook for channel "+str(channelId)+": "+str(e))
+            except discord.HTTPException as e:
+                log_event("WARNING","Couldn't check webhook for channel "+str(channelId)+": "+str(e))
+
+    def stats(self):
+        return {
+            "channels": len(self.stored),
+            "created": self.created,
+            "reused": self.reused,
+            "invalidated": self.invalidated
+        }
+
+class Metrics:
+    '''
+    Per stage latency histograms, counters & gauges, rendered in the Prometheus text format
+    Safe to update from executor threads
+    '''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                # Per bucket counts (the last one is +Inf), sum, count
+                histogram = self.histograms[stage] = [[0]*(len(self.buckets)+1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter()-start)
+
+    def timed(self, stage):
+        '''
+        Decorator timing every call of a (non async) function as stage
+        '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0)+value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    @staticmethod
+    def metric_name(*parts):
+        return "linkcleaner_"+"_".join(re.sub(r"[^a-z0-9]+", "_", re.sub(r"([a-z])([A-Z])", r"\1_\2", part).lower()).strip("_") for part in parts)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{"+",".join(name+'="'+str(value).replace("\\", "\\\\").replace('"', '\\"')+'"' for name, value in labels)+"}"
+
+    def render(self, sourceStats, gauges):
+        '''
+        Returns every metric as Prometheus text, sourceStats are (name, stats() result) pairs exported as gauges
+        '''
+        lines = ["# TYPE linkcleaner_stage_seconds histogram"]
+        with self.lock:
+            histograms = {stage: (list(counts), total, count) for stage, (counts, total, count) in self.histograms.items()}
+            counters = dict(self.counters)
+        for stage, (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets+("+Inf",), counts):
+                cumulative += bucketCount
+                lines.append('linkcleaner_stage_seconds_bucket{stage="'+stage+'",le="'+str(bound)+'"} '+str(cumulative))
+            lines.append('linkcleaner_stage_seconds_sum{stage="'+stage+'"} '+repr(total))
+            lines.append('linkcleaner_stage_seconds_count{stage="'+stage+'"} '+str(count))
+        for name in sorted({name for name, labels in counters}):
+            lines.append("# TYPE "+self.metric_name(name)+"_total counter")
+            for (counterName, labels), value in sorted(counters.items()):
+                if counterName == name:
+                    lines.append(self.metric_name(name)+"_total"+self.format_labels(labels)+" "+str(value))
+        gauges = dict(self.gauges, **gauges)
+        for sourceName, stats in sourceStats:
+            for key, value in stats.items():
+                gauges[sourceName+" "+key] = value
+        for name, value in gauges.items():
+            if isinstance(value, (int, float)):
+                lines.append("# TYPE "+self.metric_name(name)+" gauge")
+                lines.append(self.metric_name(name)+" "+str(float(value)))
+        return "\n".join(lines)+"\n"
+
+class ActionJob:
+    __slots__ = ("kind", "key", "func", "args", "future", "enqueued")
+
+    def __init__(self, kind, key, func, args, future):
+        self.kind = kind
+        self.key = key
+        self.func = func
+        self.args = args
+        self.future = future
+        self.enqueued = time.monotonic()
+
+class ActionQueue:
+    '''
+    Outbound Discord calls (sends, deletes, reactions, edits) queued per channel & run in order
+    Up to `concurrency` channels are worked on at once, discord.py tracks the per-route buckets underneath
+    Identical actions queued together (e.g. two deletes of one message) share a single call
+    A 429 that discord.py gave up on is waited out & retried once
+    '''
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.channels = {}
+        self.workers = {}
+        self.pending = {}
+        self.kinds = {}
+        self.merged = 0
+        self.rateLimited = 0
+        self.failed = 0
+
+    async def run(self, channelId, kind, key, func, *args):
+        '''
+        Queues func(*args) behind the channel's earlier actions & returns its result
+        The action still runs if the caller is cancelled
+        '''
+        if key is not None and key in self.pending:
+            self.merged += 1
+            return await asyncio.shield(self.pending[key].future)
+        job = ActionJob(kind, key, func, args, asyncio.get_running_loop().create_future())
+        self.channels.setdefault(channelId, deque()).append(job)
+        if key is not None:
+            self.pending[key] = job
+        if channelId not in self.workers:
+            self.workers[channelId] = asyncio.create_task(self.worker(channelId))
+        return await asyncio.shield(job.future)
+
+    async def worker(self, channelId):
+        queue = self.channels[channelId]
+        while queue:
+            job = queue.popleft()
+            async with self.semaphore:
+                started = time.monotonic()
+                try:
+                    result = await self.call(job)
+                except Exception as e:
+                    self.failed += 1
+                    job.future.set_exception(e)
+                else:
+                    job.future.set_result(result)
+                finally:
+                    if self.pending.get(job.key) is job:
+                        del self.pending[job.key]
+                    self.record(job.kind, started-job.enqueued, time.monotonic()-started)
+        del self.channels[channelId]
+        del self.workers[channelId]
+
+    async def call(self, job):
+        try:
+            return await job.func(*job.args)
+        except discord.HTTPException as e:
+            if e.status != 429:
+                raise
+            self.rateLimited += 1
+            retryAfter = float(e.response.headers.get("Retry-After", 1))
+            log_event("WARNING","Rate limited on "+job.kind+", retrying in "+str(retryAfter)+"s")
+            await asyncio.sleep(retryAfter)
+            return await job.func(*job.args)
+
+    def record(self, kind, wait, duration):
+        counters = self.kinds.setdefault(kind, {"count": 0, "totalWait": 0.0, "maxWait": 0.0, "totalTime": 0.0})
+        counters["count"] += 1
+        counters["totalWait"] += wait
+        counters["maxWait"] = max(counters["maxWait"], wait)
+        counters["totalTime"] += duration
+        metrics.observe("discord_"+kind, duration)
+        metrics.observe("discord_queue_wait", wait)
+
+    def send(self, message, newMsg, vidFiles):
+        return self.run(message.channel.id, "send", None, send_message, message, newMsg, vidFiles)
+
+    def delete(self, message):
+        return self.run(message.channel.id, "delete", ("delete", message.id), message.delete)
+
+    def react(self, message, emoji):
+        return self.run(message.channel.id, "react", ("react", message.id, str(emoji)), message.add_reaction, emoji)
+
+    def edit(self, message, **kwargs):
+        return self.run(message.channel.id, "edit", None, functools.partial(message.edit, **kwargs))
+
+    def stats(self):
+        '''
+        Returns queue depth plus per action counts & latency (seconds spent queued / running)
+        '''
+        stats = {
+            "queued": sum(len(queue) for queue in self.channels.values()),
+            "channels": len(self.channels),
+            "merged": self.merged,
+            "rateLimited": self.rateLimited,
+            "failed": self.failed
+        }
+        for kind, counters in self.kinds.items():
+            stats[kind] = counters["count"]
+            stats[kind+"AvgWait"] = counters["totalWait"] / counters["count"]
+            stats[kind+"MaxWait"] = counters["maxWait"]
+            stats[kind+"AvgTime"] = counters["totalTime"] / counters["count"]
+        return stats
+
+class MediaQueue:
+    '''
+    SQLite job queue between the gateway & separate media worker processes
+    The gateway queues downloads & waits for them, workers claim jobs, download/compress them into the
+    shared scratch directory & hand back the path for the gateway to upload (and remove)
+    '''
+    def __init__(self, dbPath):
+        self.dbPath = dbPath
+        self.local = threading.local()
+        db = self.connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS media_jobs (id INTEGER PRIMARY KEY, url TEXT, cache_key TEXT, name TEXT, target_size INTEGER, domain TEXT, duration REAL, deadline REAL, status TEXT, worker TEXT, path TEXT, error TEXT)")
+        db.commit()
+
+    def connect(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.dbPath, timeout=30, isolation_level=None)
+        return db
+
+    def submit(self, url, cacheKey, name, targetSize, domain, duration, deadline):
+        cursor = self.connect().execute("INSERT INTO media_jobs (url, cache_key, name, target_size, domain, duration, deadline, status) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued')", (url, cacheKey, name, targetSize, domain, duration, deadline))
+        return cursor.lastrowid
+
+    def wait(self, jobId, deadline):
+        '''
+        Blocks until a worker finishes the job, returns the output path or False if there's no video
+        '''
+        db = self.connect()
+        while time.time() < deadline:
+            row = db.execute("SELECT status, path, error FROM media_jobs WHERE id = ?", (jobId,)).fetchone()
+            if row is None:
+                # Expired & dropped by a worker
+                break
+            status, path, error = row
+            if status in ("done", "failed"):
+                db.execute("DELETE FROM media_jobs WHERE id = ?", (jobId,))
+                if status == "failed":
+                    raise RuntimeError(error)
+                return path or False
+            time.sleep(MEDIA_QUEUE_POLL_INTERVAL)
+        # Tells the worker (if any) to throw the result away
+        db.execute("UPDATE media_jobs SET status = 'abandoned' WHERE id = ?", (jobId,))
+        raise TimeoutError("Media worker didn't finish in time")
+
+    def claim(self, worker):
+        '''
+        Marks the oldest queued job as running on worker & returns it, or None if there's nothing to do
+        '''
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM media_jobs WHERE status IN ('queued', 'abandoned') AND deadline < ?", (time.time(),))
+            job = db.execute("SELECT id, url, cache_key, name, target_size, domain, duration FROM media_jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if job:
+                db.execute("UPDATE media_jobs SET status = 'running', worker = ? WHERE id = ?", (worker, job[0]))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        return job
+
+    def finish(self, jobId, path=None, error=None):
+        '''
+        Hands a job's result back, returns False if the gateway already gave up on it
+        '''
+        cursor = self.connect().execute("UPDATE media_jobs SET status = ?, path = ?, error = ? WHERE id = ? AND status = 'running'", ("failed" if error else "done", path, error, jobId))
+        if not cursor.rowcount:
+            self.connect().execute("DELETE FROM media_jobs WHERE id = ?", (jobId,))
+            return False
+        return True
+
+    def stats(self):
+        stats = {"queued": 0, "running": 0}
+        for status, count in self.connect().execute("SELECT status, COUNT(*) FROM media_jobs GROUP BY status"):
+            stats[status] = count
+        return stats
+
+metrics = Metrics(METRICS_BUCKETS)
+rules = Rules.from_file(RULES_FILE)
+
+# yt-dlp probes run here so they never block the event loop or starve downloads
+probeExecutor = ThreadPoolExecutor(max_workers=VIDEO_PROBE_WORKERS, thread_name_prefix="probe")
+videoScheduler = VideoScheduler(VIDEO_WORKERS, VIDEO_JOB_TIMEOUT)
+scratchSpace = ScratchSpace(SCRATCH_DIR, SCRATCH_SIZE_MB*1024*1024)
+actionQueue = ActionQueue(ACTION_CONCURRENCY)
+if POOL_PROCESS:
+    urlCache = probeCache = videoCache = webhookRegistry = mediaQueue = None
+else:
+    urlCache = TTLCache(URL_CACHE_SIZE, URL_CACHE_TTL, URL_CACHE_NEGATIVE_TTL, URL_CACHE_DB, "urls")
+    probeCache = TTLCache(VIDEO_PROBE_CACHE_SIZE, VIDEO_PROBE_TTL, VIDEO_PROBE_NEGATIVE_TTL, VIDEO_PROBE_CACHE_DB, "video_probes")
+    videoCache = VideoCache(VIDEO_CACHE_DIR, VIDEO_CACHE_SIZE_MB*1024*1024)
+    webhookRegistry = WebhookRegistry("LinkCleaner2", WEBHOOK_DB)
+    mediaQueue = MediaQueue(MEDIA_QUEUE_DB) if MEDIA_QUEUE_DB else None
+    BLACKLISTED_USERS.extend(str(webhookId) for webhookId in webhookRegistry.webhook_ids())
 
 #################
 ### FUNCTIONS ###
@@ -73,19 +1215,147 @@ def log_event(level,event):
     '''
     Cleans up log entries
     '''
+    metrics.inc("log_events", level=level.upper())
     for i in range(8-len(level)):
         level = level+" "
     print("["+datetime.now().strftime('%Y-%m-%d %H:%M:%S')+"] ["+level.upper()+"] "+event)
 
+@functools.cache
+def load_yt_dlp():
+    '''
+    Imports yt-dlp on first use, it's by far the slowest import and most messages never need it
+    '''
+    import yt_dlp
+    return yt_dlp
+
+@functools.cache
+def load_ffmpeg():
+    '''
+    Imports ffmpeg-python on first use
+    '''
+    import ffmpeg # You might need to manually install ffmpeg, pip didn't properly install it
+    return ffmpeg
+
+def load_media_modules():
+    '''
+    Imports the media modules ahead of the first video, returns how long it took
+    '''
+    start = time.perf_counter()
+    load_yt_dlp()
+    load_ffmpeg()
+    return time.perf_counter()-start
+
+async def warm_up_media():
+    '''
+    Loads the media modules in the background once the gateway is connected
+    '''
+    seconds = await asyncio.get_running_loop().run_in_executor(probeExecutor, load_media_modules)
+    log_event("INFO","Media modules loaded in "+format(seconds, ".2f")+"s")
+
+def record_first_message():
+    '''
+    Logs & exports the time from startup until the first message was handled
+    '''
+    global firstMessageSeconds
+    if firstMessageSeconds is None:
+        firstMessageSeconds = time.monotonic()-bootTime
+        metrics.set_gauge("startup first message seconds", firstMessageSeconds)
+        log_event("INFO","First message handled "+format(firstMessageSeconds, ".2f")+"s after startup")
+
+def command_tree_hash():
+    '''
+    Returns a hash of the command tree as it's sent to Discord when syncing
+    '''
+    payload = [command.to_dict(tree) for command in tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def load_command_hashes():
+    '''
+    Returns the stored {application id: command tree hash} of the last syncs
+    '''
+    try:
+        with open(COMMAND_HASH_FILE, encoding="utf-8") as hashFile:
+            return json.load(hashFile)
+    except (OSError, ValueError):
+        return {}
+
+async def sync_commands():
+    '''
+    Syncs the command tree only when it changed since the last sync stored in COMMAND_HASH_FILE
+    '''
+    treeHash = command_tree_hash()
+    applicationId = str(client.application_id)
+    hashes = load_command_hashes() if COMMAND_HASH_FILE else {}
+    if hashes.get(applicationId) == treeHash:
+        log_event("INFO","Command tree unchanged, skipping sync")
+        return
+    try:
+        await tree.sync()
+    except discord.HTTPException as e:
+        log_event("ERROR","Couldn't sync commands: "+str(e))
+        return
+    log_event("INFO","Synced "+str(len(tree.get_commands()))+" commands")
+    if COMMAND_HASH_FILE:
+        hashes[applicationId] = treeHash
+        try:
+            with open(COMMAND_HASH_FILE, "w", encoding="utf-8") as hashFile:
+                json.dump(hashes, hashFile)
+        except OSError as e:
+            log_event("WARNING","Couldn't store the command tree hash: "+str(e))
+
+@functools.cache
+def get_public_suffix_trie():
+    '''
+    Loads the bundled public suffix list into a trie keyed by reversed domain labels
+    Nodes mark rules with "$" and exception rules (!rule) with "!"
+    '''
+    trie = {}
+    with open(PUBLIC_SUFFIX_LIST, encoding="utf-8") as suffixFile:
+        for line in suffixFile:
+            rule = line.strip()
+            if not rule or rule.startswith("//"):
+                continue
+            exception = rule[0] == "!"
+            node = trie
+            for label in reversed(rule.lstrip("!").lower().split(".")):
+                node = node.setdefault(label, {})
+            node["!" if exception else "$"] = True
+    return trie
+
+def find_public_suffix(labels):
+    '''
+    Returns how many of the rightmost labels of a host form its public suffix
+    '''
+    node = get_public_suffix_trie()
+    suffixLength = 1
+    for depth in range(1, len(labels)+1):
+        label = labels[-depth]
+        exact = node.get(label)
+        wildcard = node.get("*")
+        if exact is not None and "!" in exact:
+            # Exception rules take priority, the suffix is the rule minus its first label
+            return depth-1
+        if (exact is not None and "$" in exact) or (wildcard is not None and "$" in wildcard):
+            suffixLength = depth
+        node = exact if exact is not None else wildcard
+        if node is None:
+            break
+    return suffixLength
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+@metrics.timed("parse_url")
 def parse_url(url):
     '''
-    Splits a URL into it's components
+    Splits a URL into it's components, returns a ParsedURL or False if the URL is invalid
+    Results are memoized since the same URL is usually parsed several times
 
     https ://   www    . example . com / testpage ? test=yes # completed
     └─┰─┘      └─┰─┘     └──┰──┘   └┰┘   └──┰───┘   └──┰───┘   └───┰───┘
-    scheme | subdomain | domain  | tld |   path   |  params  |  fragment
+    scheme | subdomain | domain  | tld |   path   |  query   |  fragment
              └───────────┰───────────┘
          fully qualified domain name (fqdn)
+
+    tld is the public suffix of the fqdn (e.g. co.uk, com.au, github.io)
     '''
 
     # Basic validation check
@@ -96,189 +1366,510 @@ def parse_url(url):
 
     # Extract Scheme
     if url.count('://') == 1:
-        scheme = url[0:url.find('://')]
+        scheme, rest = url.split('://')
     else:
         # Return False for invalid URLs
         log_event("ERROR","URL provided is invalid")
         return False
 
-    # Extract combined (subdoamin), domain, tld
-
-    seperatorPosDict = {}
+    # Split net location from path, query & fragment
+    hostEnd = len(rest)
     for seperator in ('/','?','#'):
-        seperatorPosDict[seperator] = url[len(scheme)+3:].find(seperator)
-    # Set netLocation (combined subdomain, domain, tld) by finding position of first
-    netLocation = url[len(scheme)+3:min(i for i in (seperatorPosDict["/"],seperatorPosDict["?"],seperatorPosDict["#"],len(url)-len(scheme)-3) if i > 0)+len(scheme)+3]
-
-    # Extract TLD
-    if netLocation.count('.') > 1:
-        # Check if TLD is country code (.co.xx)
-        if netLocation[netLocation.rfind('.')-2:netLocation.rfind('.')] == 'co':
-            # TLD is country code
-            tld = netLocation[netLocation.rfind('.')-2:]
-        else:
-            # TLD is not country code
-            tld = netLocation[netLocation.rfind('.')+1:]
-    else:
-        # TLD cannot be country code
-        tld = netLocation[netLocation.find('.')+1:]
+        seperatorPos = rest.find(seperator)
+        if seperatorPos != -1 and seperatorPos < hostEnd:
+            hostEnd = seperatorPos
+    netLocation = rest[:hostEnd]
+    rest, _, fragment = rest[hostEnd:].partition('#')
+    rest, _, query = rest.partition('?')
+    path = rest[1:]
 
-    # Extract subdomain (if exists)
-    if netLocation[0:netLocation.rfind(tld)-1].count('.') > 0:
-        subdomain = netLocation[0:netLocation[0:netLocation.rfind(tld)-1].rfind('.')]
+    # Drop credentials & port from the net location
+    fqdn = netLocation.rpartition('@')[2]
+    if fqdn.startswith('['):
+        fqdn = fqdn[:fqdn.find(']')+1]
+    elif ':' in fqdn:
+        fqdn = fqdn[:fqdn.find(':')]
+    fqdn = fqdn.rstrip('.').lower()
+    if not fqdn:
+        log_event("ERROR","URL provided is invalid (no host)")
+        return False
+
+    # Split fqdn on the public suffix (IP addresses don't have one)
+    if fqdn[-1].isdigit() or fqdn[0] == '[':
+        try:
+            ipaddress.ip_address(fqdn.strip('[]'))
+            return ParsedURL(scheme, fqdn, '', fqdn, '', path, query, fragment)
+        except ValueError:
+            pass
+    labels = fqdn.split('.')
+    suffixLength = find_public_suffix(labels)
+    tld = '.'.join(labels[-suffixLength:])
+    if len(labels) > suffixLength:
+        domain = labels[-suffixLength-1]
+        subdomain = '.'.join(labels[:-suffixLength-1])
     else:
-        # No subdomain
+        domain = ''
         subdomain = ''
 
-    # Extract what's left of the domain
-    if len(subdomain) > 0:
-        # If subdomain exists remove period
-        domain = netLocation[len(subdomain)+1:netLocation.rfind(tld)-1]
-    else:
-        # Else it's not needed
-        domain = netLocation[:netLocation.rfind(tld)-1]
-
-    # Extract Path
-    if seperatorPosDict["/"] > 0:
-        if seperatorPosDict["#"] > 0 or seperatorPosDict["?"] > 0:
-            # path ends at params/fragment
-            path = url[seperatorPosDict["/"]+len(scheme)+4:min(i for i in (seperatorPosDict["?"],seperatorPosDict["#"]) if i > 0)+len(scheme)+3]
-        else:
-            # No params/fragment
-            path = url[seperatorPosDict["/"]+len(scheme)+4:]
-    else:
-        # No path
-        path = ''
-
-    # Extract params & fragment
-    if seperatorPosDict["?"] > 0:
-        if seperatorPosDict["#"] > 0 and seperatorPosDict["#"] > seperatorPosDict["?"]:
-            # fragment present
-            fragment = url[seperatorPosDict["#"]+len(scheme)+4:]
-            params = url[seperatorPosDict["?"]+len(scheme)+4:seperatorPosDict["#"]+len(scheme)+3]
-        else:
-            # No fragment, catch edge case of # before
-            fragment = ''
-            params = url[seperatorPosDict["?"]+len(scheme)+4:]
-    elif seperatorPosDict["#"] > 0:
-        # No params but fragment
-        fragment = url[seperatorPosDict["#"]+len(scheme)+4:]
-        params = ''
-    else:
-        # No params or fragment
-        fragment = ''
-        params = ''
-
-    # Break params into dict
-    paramsDict = {}
-    if params:
-        for param in params.split("&"):
-            if param.count("=") == 1:
-                paramsDict[param.split("=")[0]] = param.split("=")[1]
-            else:
-                # Malformed params
-                log_event("WARNING","URL contains malformed parameters")
-
-    parsedURL = {
-        "scheme": scheme,
-        "fqdn": netLocation,
-        "subdomain": subdomain,
-        "domain": domain,
-        "tld": tld,
-        "path": path,
-        "params": paramsDict,
-        "fragment": fragment
-    }
+    return ParsedURL(scheme, fqdn, subdomain, domain, tld, path, query, fragment)
 
-    return parsedURL
+async def get_http_session():
+    '''
+    Returns the shared keep-alive HTTP session, creating it if needed
+    '''
+    global httpSession
+    if httpSession is None or httpSession.closed:
+        connector = aiohttp.TCPConnector(limit=REDIRECT_POOL_SIZE, ttl_dns_cache=300)
+        httpSession = aiohttp.ClientSession(connector=connector, headers=REDIRECT_HEADERS)
+    return httpSession
+
+def get_host_semaphore(host):
+    '''
+    Returns the semaphore limiting concurrent requests to a single host
+    '''
+    if host not in hostSemaphores:
+        hostSemaphores[host] = asyncio.Semaphore(REDIRECT_HOST_CONCURRENCY)
+    return hostSemaphores[host]
+
+async def request_hop(session, method, url, headers):
+    '''
+    Makes a single request without following redirects, returns (status, location)
+    '''
+    async with get_host_semaphore(urlsplit(url).hostname):
+        async with timeout(REDIRECT_HOP_TIMEOUT):
+            async with session.request(method, url, headers=headers, allow_redirects=False) as response:
+                return response.status, response.headers.get("Location")
+
+async def resolve_redirects(url):
+    '''
+    Follows redirects for URL using HEAD (falling back to a ranged GET), returns final URL or False
+    '''
+    session = await get_http_session()
+    for hop in range(REDIRECT_MAX_HOPS):
+        try:
+            status, location = await request_hop(session, "HEAD", url, {})
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            status, location = None, None
+        if status is None or status == 405 or status >= 400:
+            # Some hosts reject HEAD, only ask for the first byte of the body
+            try:
+                status, location = await request_hop(session, "GET", url, {"Range": "bytes=0-0"})
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                if hop == 0:
+                    return False
+                # Keep the last URL we managed to reach
+                return url
+        if status in REDIRECT_STATUS_CODES and location:
+            url = urljoin(url, location)
+        else:
+            return url
+    log_event("WARNING","Too many redirects, stopping at "+url)
+    return url
 
-def clean_url(url):
+async def clean_url(url):
     '''
-    Cleans and redirects provided URL
+    Cleans and redirects provided URL (cached)
+    URLs whose redirects can't change them are cleaned offline without touching the cache
     '''
+    if URL_PREFILTER:
+        parsedURL = parse_url(url)
+        if parsedURL and not rules.needs_redirect_check(parsedURL):
+            return clean_url_offline(url)
+
+    cachedURL = urlCache.get(url)
+    if cachedURL is not CACHE_MISS:
+        return cachedURL
+
     # Parse URL
     if not parse_url(url):
         # URL is invalid
         log_event("ERROR","URL provided is invalid")
+        urlCache.set(url, False, negative=True)
         return False
 
+    cleanURL, resolved = await clean_url_uncached(url)
+    urlCache.set(url, cleanURL, negative=not resolved)
+    return cleanURL
+
+async def clean_url_uncached(url):
+    '''
+    Cleans and redirects provided URL, returns (cleaned URL, whether redirect resolution succeeded)
+    '''
     # Check if URL redirects
-    try:
-        if parse_url(requests.get(url).url)["domain"] != parse_url(url)["domain"] and parse_url(url)["domain"] not in IGNORED_REDIRECT_DOMAINS:
-            url = requests.get(url).url
-    except:
+    with metrics.timer("redirect"):
+        redirectedURL = await resolve_redirects(url)
+    if not redirectedURL:
         log_event("ERROR","Failed to request URL")
+    elif parse_url(redirectedURL) and parse_url(redirectedURL).domain != parse_url(url).domain and parse_url(url).domain not in rules.ignoredRedirectDomains:
+        url = redirectedURL
 
+    return clean_url_offline(url), bool(redirectedURL)
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def clean_url_offline(url):
+    '''
+    Removes tracking parameters & applies the domain redirect rules, no network requests (memoized)
+    '''
     # Clean URL
-    cleanURL = URLCleaner().clean_url(url)
+    with metrics.timer("url_cleaner"):
+        cleanURL = urlCleaner.clean_url(url)
     parsedURL = parse_url(cleanURL)
 
     # Check if Domain is ignored
-    if parsedURL["domain"] in IGNORED_CLEAN_DOMAINS:
+    if not parsedURL or parsedURL.domain in rules.ignoredCleanDomains:
         return url
 
     # Redirect Domains
-    for key in REDIRECTED_FQDNS:
-        if key == parsedURL["domain"]+"."+parsedURL["tld"]:
-            cleanURL = cleanURL.replace(key, REDIRECTED_FQDNS[key])
+    redirect = rules.redirect_for(parsedURL)
+    if redirect:
+        cleanURL = cleanURL.replace(redirect[0], redirect[1], 1)
 
     # Return URL
     return cleanURL
 
-def clean_message(message,extractURLs):
+def reload_rules():
+    '''
+    Reloads RULES_FILE if it changed, keeping the current rules if the new ones are invalid
+    '''
+    global rules
+    try:
+        if os.path.getmtime(RULES_FILE) == rules.mtime:
+            return False
+        newRules = Rules.from_file(RULES_FILE)
+    except (OSError, ValueError, re.error) as e:
+        log_event("ERROR","Failed to reload rules: "+str(e))
+        return False
+    rules = newRules
+    # Cached URLs were cleaned using the old rules
+    urlCache.clear()
+    clean_url_offline.cache_clear()
+    log_event("INFO","Reloaded rules from "+RULES_FILE)
+    return True
+
+async def watch_rules():
+    '''
+    Periodically checks RULES_FILE for changes
+    '''
+    while True:
+        await asyncio.sleep(RULES_RELOAD_INTERVAL)
+        reload_rules()
+
+async def sweep_scratch():
+    '''
+    Clears scratch space left over from previous runs, then periodically sweeps orphaned files
+    '''
+    # Media workers share the scratch directory, their jobs may still be running
+    swept = scratchSpace.sweep(SCRATCH_MAX_AGE if mediaQueue else 0)
+    if swept:
+        log_event("INFO","Removed "+str(swept)+" leftover scratch directories")
+    while True:
+        await asyncio.sleep(SCRATCH_SWEEP_INTERVAL)
+        swept = scratchSpace.sweep(SCRATCH_MAX_AGE)
+        if swept:
+            log_event("WARNING","Removed "+str(swept)+" orphaned scratch directories")
+
+def stats_sources():
     '''
-    Cleans URLs in message & replaces them
+    Returns (name, object) pairs for everything with a stats() method
     '''
+    sources = [("URL cache", urlCache), ("Video probe cache", probeCache), ("Video cache", videoCache), ("Video queue", videoScheduler), ("Scratch space", scratchSpace), ("Webhooks", webhookRegistry), ("Discord actions", actionQueue)]
+    if mediaQueue:
+        sources.append(("Media queue", mediaQueue))
+    return sources
 
-    if extractURLs:
-        extractedUrls = []
+async def collect_stats():
+    '''
+    Returns (name, stats) pairs for every stats source
+    The scratch space (walks SCRATCH_DIR) & media queue (SQLite) are read on the default executor
+    '''
+    loop = asyncio.get_running_loop()
+    sourceStats = []
+    for name, source in stats_sources():
+        if source is scratchSpace or source is mediaQueue:
+            sourceStats.append((name, await loop.run_in_executor(None, source.stats)))
+        else:
+            sourceStats.append((name, source.stats()))
+    return sourceStats
+
+async def log_stats():
+    '''
+    Periodically logs cache & video queue counters
+    '''
+    while True:
+        await asyncio.sleep(CACHE_STATS_INTERVAL)
+        for name, stats in await collect_stats():
+            log_event("INFO",name+": "+", ".join(key+"="+(format(value, ".2f") if isinstance(value, float) else str(value)) for key, value in stats.items()))
+
+async def monitor_event_loop():
+    '''
+    Measures how late the event loop wakes up from a sleep (time spent blocked by other work)
+    '''
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic()-start-EVENT_LOOP_LAG_INTERVAL)
+        metrics.observe("event_loop_lag", lag)
+        metrics.set_gauge("event loop lag seconds", lag)
+
+async def serve_metrics():
+    '''
+    Serves /metrics in the Prometheus text format on METRICS_HOST:METRICS_PORT
+    '''
+    async def handle_metrics(request):
+        gauges = {
+            "probe executor queued": probeExecutor._work_queue.qsize(),
+            "probes in flight": len(inFlightProbes),
+            "reaction jobs": len(reactionJobs),
+            "url parse cache size": parse_url.cache_info().currsize
+        }
+        text = metrics.render(await collect_stats(), gauges)
+        return web.Response(body=text.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log_event("INFO","Serving metrics on http://"+METRICS_HOST+":"+str(METRICS_PORT)+"/metrics")
+    await monitor_event_loop()
+
+def tokenize_message(content):
+    '''
+    Splits message content into parts (joining them gives back the content) & the indexes of parts that are URLs
+    URLs inside code blocks are skipped
+    '''
+    parts = []
+    urlIndexes = []
     # Split on code blocks
-    multiCodeSecs = message.content.split("```")
-    for i in range(len(multiCodeSecs))[0::2]:
+    multiCodeSecs = content.split("```")
+    for i in range(len(multiCodeSecs)):
+        if i > 0:
+            parts.append("```")
+        if i % 2:
+            parts.append(multiCodeSecs[i])
+            continue
         singleCodeSecs = multiCodeSecs[i].split("`")
-        for j in range(len(singleCodeSecs))[0::2]:
-            # Split message by lines
-            msgLines = singleCodeSecs[j].split("\n")
-            for k in range(len(msgLines)):
-                # Split line by spaces
-                msgWords = msgLines[k].split(" ")
-                for l in range(len(msgWords)):
-                    if msgWords[l][0:4] == "http":
-                        cleanedUrl = clean_url(msgWords[l])
-                        if extractURLs:
-                            extractedUrls.append(cleanedUrl)
-                        elif cleanedUrl and cleanedUrl != msgWords[l]:
-                            msgWords[l] = cleanedUrl
-                msgLines[k] = " ".join(msgWords)
-            singleCodeSecs[j] = "\n".join(msgLines)
-        multiCodeSecs[i] = "`".join(singleCodeSecs)
-    newMsg = "```".join(multiCodeSecs)
-
-    if extractURLs:
-        return extractedUrls
-    elif newMsg != message.content:
-        return newMsg
+        for j in range(len(singleCodeSecs)):
+            if j > 0:
+                parts.append("`")
+            if j % 2:
+                parts.append(singleCodeSecs[j])
+                continue
+            # Split by lines & spaces, keeping the separators
+            for msgWord in re.split(r"([ \n])", singleCodeSecs[j]):
+                if msgWord[0:4] == "http":
+                    urlIndexes.append(len(parts))
+                parts.append(msgWord)
+    return parts, urlIndexes
+
+async def analyze_message(content, clean=True):
+    '''
+    Tokenizes message content once & cleans every URL in it concurrently
+    Returns a MessageAnalysis, call probe_videos() on it to test URLs for videos
+    '''
+    with metrics.timer("tokenize"):
+        parts, urlIndexes = tokenize_message(content)
+    rawUrls = [parts[i] for i in urlIndexes]
+    uniqueUrls = list(dict.fromkeys(rawUrls))
+    if clean:
+        cleanedUrls = dict(zip(uniqueUrls, await asyncio.gather(*[clean_url(url) for url in uniqueUrls])))
     else:
-        return False
+        cleanedUrls = {url: url for url in uniqueUrls}
+
+    urls = []
+    parsedUrls = {}
+    for i in urlIndexes:
+        rawURL = parts[i]
+        cleanURL = cleanedUrls[rawURL] or rawURL
+        if cleanURL not in parsedUrls:
+            parsedUrls[cleanURL] = parse_url(cleanURL)
+        urls.append(AnalyzedURL(rawURL, cleanURL, parsedUrls[cleanURL]))
+        parts[i] = cleanURL
+
+    newContent = "".join(parts)
+    if newContent == content:
+        newContent = False
+    return MessageAnalysis(content, newContent, urls)
+
+def link_or_copy(source, destination):
+    '''
+    Hard links source to destination, copying it if they're on different filesystems
+    '''
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(source, destination)
 
-def compress_video(input_file, output_file, boosted, count):
+def get_upload_limit(channel):
+    '''
+    Returns the number of bytes that can be uploaded to a channel (DMs use Discord's default limit)
+    '''
+    guild = getattr(channel, "guild", None)
+    if guild:
+        return guild.filesize_limit
+    return discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+
+def allocate_video_budgets(urls, totalBytes):
+    '''
+    Splits an upload budget between a message's videos, returns the target size (kB) for each
+    Videos whose probed size (plus the format selector's margin) fits an even share of what's left keep that size & are left out of the split,
+    the rest share what's left in proportion to duration * probed bitrate
+    '''
+    budgets = [None]*len(urls)
+    sizes = [url.probe["filesize"] if url.probe else None for url in urls]
+    durations = [url.probe["duration"] if url.probe else None for url in urls]
+    knownDurations = [duration for duration in durations if duration]
+    defaultDuration = sum(knownDurations) / len(knownDurations) if knownDurations else 1
+    durations = [duration or defaultDuration for duration in durations]
+    knownBitrates = [size / duration for size, duration in zip(sizes, durations) if size]
+    defaultBitrate = sum(knownBitrates) / len(knownBitrates) if knownBitrates else 1
+    weights = [duration * (size / duration if size else defaultBitrate) for size, duration in zip(sizes, durations)]
+
+    remaining = totalBytes * UPLOAD_LIMIT_MARGIN
+    pending = list(range(len(urls)))
+    while pending:
+        share = remaining / len(pending)
+        # select_video_format only picks formats up to FORMAT_SIZE_MARGIN of the budget, the probed format has to pass that too
+        fitting = [index for index in pending if sizes[index] and sizes[index] / FORMAT_SIZE_MARGIN <= share]
+        if not fitting:
+            break
+        for index in fitting:
+            # Probed sizes are estimates, leave a little headroom so they aren't re-encoded
+            budgets[index] = min(sizes[index] * 1.05 / FORMAT_SIZE_MARGIN, share)
+            remaining -= budgets[index]
+            pending.remove(index)
+    totalWeight = sum(weights[index] for index in pending)
+    for index in pending:
+        budgets[index] = remaining * weights[index] / totalWeight
+    return [int(budget / 1000) for budget in budgets]
+
+def estimate_format_size(videoFormat, duration):
+    '''
+    Estimates a yt-dlp format's size in bytes from its metadata, None if unknown
+    '''
+    size = videoFormat.get("filesize") or videoFormat.get("filesize_approx")
+    if not size and videoFormat.get("tbr") and duration:
+        # tbr is in kbit/s
+        size = videoFormat["tbr"] * 125 * duration
+    return size
+
+def is_remuxable(videoFormat, audioFormat=None):
+    '''
+    Checks if a format's (or video+audio pair's) codecs can be sent on Discord without transcoding
+    '''
+    audioFormat = audioFormat or videoFormat
+    return (videoFormat.get("vcodec") or "none").startswith(REMUX_VIDEO_CODECS) and (audioFormat.get("acodec") or "none").startswith(REMUX_AUDIO_CODECS)
+
+def select_video_format(maxBytes, duration):
+    '''
+    Returns a yt-dlp format selector picking the best quality format (or video+audio pair) that fits in maxBytes
+    Formats that only need remuxing are preferred, if nothing fits the smallest format is used & compressed afterwards
+    '''
+    def selector(ctx):
+        formats = ctx.get("formats", [])
+        videoFormats = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") == "none"]
+        audioFormats = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")]
+        candidates = []
+        for f in formats:
+            if f.get("vcodec") != "none" and f.get("acodec") != "none":
+                candidates.append(([f], is_remuxable(f), estimate_format_size(f, duration)))
+        for videoFormat in videoFormats:
+            for audioFormat in audioFormats:
+                videoSize = estimate_format_size(videoFormat, duration)
+                audioSize = estimate_format_size(audioFormat, duration)
+                size = videoSize+audioSize if videoSize and audioSize else None
+                candidates.append(([videoFormat, audioFormat], is_remuxable(videoFormat, audioFormat), size))
+        if not audioFormats:
+            # Silent clips (reddit, ifunny) only have video-only formats, "none" counts as a remuxable audio codec
+            for videoFormat in videoFormats:
+                candidates.append(([videoFormat], is_remuxable(videoFormat), estimate_format_size(videoFormat, duration)))
+        if not candidates:
+            return
+
+        def quality(candidate):
+            videoFormat = candidate[0][0]
+            return (candidate[1], videoFormat.get("height") or 0, sum(f.get("tbr") or 0 for f in candidate[0]))
+
+        fitting = [candidate for candidate in candidates if candidate[2] and candidate[2] <= maxBytes * FORMAT_SIZE_MARGIN]
+        if fitting:
+            chosen = max(fitting, key=quality)
+        elif any(candidate[2] for candidate in candidates):
+            # Nothing fits, download the smallest format to compress it
+            chosen = min((candidate for candidate in candidates if candidate[2]), key=lambda candidate: (candidate[2], not candidate[1]))
+        else:
+            # No size information at all
+            chosen = max(candidates, key=quality)
+
+        chosenFormats = chosen[0]
+        if len(chosenFormats) == 1:
+            yield chosenFormats[0]
+        else:
+            videoFormat, audioFormat = chosenFormats
+            yield {
+                "format_id": videoFormat["format_id"]+"+"+audioFormat["format_id"],
+                "ext": "mp4",
+                "requested_formats": chosenFormats,
+                "protocol": videoFormat.get("protocol", "")+"+"+audioFormat.get("protocol", "")
+            }
+    return selector
+
+def get_compression_pool(brokenPool=None):
+    '''
+    Returns the process pool encodes run in, creating it if needed or replacing brokenPool
+    '''
+    global compressionPool
+    # Called from every video worker thread, only one may create (or replace) the pool
+    with compressionPoolLock:
+        if compressionPool is not None and compressionPool is brokenPool:
+            compressionPool.shutdown(wait=False, cancel_futures=True)
+            compressionPool = None
+        if compressionPool is None:
+            compressionPool = ProcessPoolExecutor(max_workers=COMPRESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return compressionPool
+
+def run_in_compression_pool(func, *args):
+    '''
+    Runs func(*args) in the compression pool
+    A pool process dying (OOM kill, crash) breaks the whole pool, it's replaced & the job retried once
     '''
-    Compresses video to target size
+    pool = get_compression_pool()
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        log_event("WARNING","A compression process died, restarting the compression pool")
+        return get_compression_pool(pool).submit(func, *args).result()
+
+def run_ffmpeg(stream, deadline):
+    '''
+    Runs an ffmpeg-python stream, killing ffmpeg if it's still running at deadline (time.monotonic())
+    '''
+    process = stream.global_args('-nostdin').overwrite_output().run_async()
+    try:
+        returnCode = process.wait(timeout=max(deadline-time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise TimeoutError("ffmpeg timed out")
+    if returnCode != 0:
+        raise RuntimeError("ffmpeg exited with code "+str(returnCode))
+
+def encode_video(input_file, output_file, target_size, probe, mode, time_limit):
+    '''
+    Encodes video to target size (kB), runs in the compression pool
+    Each encode gets its own working directory so two-pass logs never clash
+    mode is "twopass" (exact size) or "fast" (single pass, CRF capped at the target bitrate)
+    Returns stats about the encode
     Stolen from https://stackoverflow.com/questions/64430805/how-to-compress-video-to-target-size-by-python
     '''
-    if boosted:
-        target_size = 50000/count
-    else:
-        target_size = 10000/count
-    if os.path.getsize(input_file) <= target_size * 1000: 
-        os.rename(input_file, output_file)
-        return(output_file)
-    else:
+    start = time.monotonic()
+    deadline = start + time_limit
+    workDir = tempfile.mkdtemp(prefix="encode-", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
         # Reference: https://en.wikipedia.org/wiki/Bit_rate#Encoding_bit_rate
         min_audio_bitrate = 32000
         max_audio_bitrate = 256000
 
-        probe = ffmpeg.probe(input_file)
         # Video duration, in s.
         duration = float(probe['format']['duration'])
         # Audio bitrate, in bps.
@@ -299,139 +1890,388 @@ def compress_video(input_file, output_file, boosted, count):
         # Target video bitrate, in bps.
         video_bitrate = target_total_bitrate - audio_bitrate
 
-        i = ffmpeg.input(input_file)
-        ffmpeg.output(i, os.devnull,
-                    **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 1, 'f': 'mp4'}
-                    ).overwrite_output().run()
-        ffmpeg.output(i, output_file,
-                    **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 2, 'c:a': 'aac', 'b:a': audio_bitrate}
-                    ).overwrite_output().run()
+        i = load_ffmpeg().input(input_file)
+        passes = 0
+        passTimes = {}
+        if mode == "fast":
+            passStart = time.monotonic()
+            run_ffmpeg(load_ffmpeg().output(i, output_file,
+                        **{'c:v': 'libx264', 'preset': COMPRESS_PRESET, 'crf': COMPRESS_CRF, 'maxrate': video_bitrate, 'bufsize': video_bitrate, 'threads': COMPRESS_THREADS, 'c:a': 'aac', 'b:a': audio_bitrate}
+                        ), deadline)
+            passTimes["fast"] = time.monotonic()-passStart
+            passes += 1
+            if os.path.getsize(output_file) > target_size * 1000:
+                # VBV overshot the target, fall back to two passes
+                mode = "twopass"
+        if mode != "fast":
+            passLog = os.path.join(workDir, "ffmpeg2pass")
+            passStart = time.monotonic()
+            run_ffmpeg(load_ffmpeg().output(i, os.devnull,
+                        **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 1, 'passlogfile': passLog, 'threads': COMPRESS_THREADS, 'f': 'mp4'}
+                        ), deadline)
+            passTimes["pass1"] = time.monotonic()-passStart
+            passStart = time.monotonic()
+            run_ffmpeg(load_ffmpeg().output(i, output_file,
+                        **{'c:v': 'libx264', 'b:v': video_bitrate, 'pass': 2, 'passlogfile': passLog, 'threads': COMPRESS_THREADS, 'c:a': 'aac', 'b:a': audio_bitrate}
+                        ), deadline)
+            passTimes["pass2"] = time.monotonic()-passStart
+            passes += 2
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    wallTime = time.monotonic()-start
+    return {
+        "mode": mode,
+        "passes": passes,
+        "passTimes": passTimes,
+        "wallTime": wallTime,
+        "duration": duration,
+        "speed": duration / wallTime if wallTime else 0.0,
+        "inputBytes": os.path.getsize(input_file),
+        "outputBytes": os.path.getsize(output_file),
+        "throughput": os.path.getsize(input_file) / wallTime if wallTime else 0.0
+    }
+
+def compress_video(input_file, output_file, target_size):
+    '''
+    Compresses video to target size (kB), encoding in the compression pool if it doesn't already fit
+    '''
+    probe = load_ffmpeg().probe(input_file)
+    videoStream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if os.path.getsize(input_file) <= target_size * 1000 and (videoStream is None or videoStream.get('codec_name') == 'h264'):
+        # Already fits & plays on Discord
+        os.rename(input_file, output_file)
+        return(output_file)
+    else:
+        stats = run_in_compression_pool(encode_video, input_file, output_file, target_size, probe, COMPRESS_MODE, COMPRESS_TIMEOUT)
+        for passName, passTime in stats["passTimes"].items():
+            metrics.observe("compress_"+passName, passTime)
+        log_event("INFO","Encoded "+os.path.basename(output_file)+" ("+stats["mode"]+"): "+format(stats["wallTime"], ".1f")+"s wall, "+format(stats["speed"], ".2f")+"x realtime, "+format(stats["throughput"]/1e6, ".2f")+" MB/s, "+str(stats["inputBytes"])+" -> "+str(stats["outputBytes"])+" bytes")
         os.remove(input_file)
         return(output_file)
 
-def fetch_compress_video(url, ydl_opts, video_full_path, boosted, count):
+def fetch_compress_video(url, ydl_opts, video_full_path, target_size):
     '''
     Fetch video through YT-DLP & compress it to send on Discord
     '''
-    with YoutubeDL(ydl_opts) as ydl:
+    with load_yt_dlp().YoutubeDL(ydl_opts) as ydl:
         try:
-            ydl.download(url)
-            compress_output = compress_video(video_full_path+".mp4", video_full_path+"-compressed.mp4", boosted, count)
+            with metrics.timer("download"):
+                ydl.download(url)
+            compress_output = compress_video(video_full_path+".mp4", video_full_path+"-compressed.mp4", target_size)
             return compress_output
         except Exception as e:
             print(e)
             return False
 
-async def fetch_thread(channel, fetch_compress_video: typing.Callable, *args, **kwargs) -> typing.Any:
+def load_video_result(path, name):
     '''
-    Called to run fetch_compress_video in seperate thread (to preserve heartbeat)
+    Wraps a finished video in a VideoResult, small videos are read into memory
     '''
-    async with channel.typing():
-        return await client.loop.run_in_executor(None, functools.partial(fetch_compress_video, *args, **kwargs))
+    if os.path.getsize(path) <= SCRATCH_MEMORY_UPLOAD_MB*1024*1024:
+        with open(path, "rb") as videoFile:
+            return VideoResult(name, data=videoFile.read())
+    return VideoResult(name, path=path)
 
-def test_url_for_video(url,parsedURL):
-    if parsedURL["domain"] in IGNORED_VIDEO_DOMAINS:
+def fetch_cached_video(cacheKey, name):
+    '''
+    Returns a VideoResult for a cached video, or False if it isn't cached
+    '''
+    cachePath = videoCache.get(cacheKey)
+    if not cachePath:
         return False
-    for path in INVALID_VIDEO_PATHS:
-        if path[0] == "*" and path[-1] == "*":
-            if path.replace("*","") in parsedURL["path"]:
-                return False
-        elif path[-1] == "*":
-            if path.replace("*","") == parsedURL["path"][0:len(path.replace("*",""))]:
-                return False
-        elif path[0] == "*":
-            if path.replace("*","") == parsedURL["path"][len(path.replace("*",""))*-1:]:
-                return False
     try:
-        with YoutubeDL({"simulate": True, "format": "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4] / bv*+ba/b"}) as ydl:
-            ydl.download(url)
-        return True
+        if os.path.getsize(cachePath) <= SCRATCH_MEMORY_UPLOAD_MB*1024*1024:
+            return load_video_result(cachePath, name)
+        return VideoResult(name, path=link_cached_video(cachePath, name))
+    except FileNotFoundError:
+        videoCache.discard(cacheKey)
+        return False
+
+def link_cached_video(cachePath, name):
+    '''
+    Links a cached video into a new scratch directory so eviction can't remove it mid upload
+    '''
+    jobDir = scratchSpace.create_job_dir()
+    try:
+        link_or_copy(cachePath, os.path.join(jobDir, name))
+    except OSError:
+        scratchSpace.remove(jobDir)
+        raise
+    return os.path.join(jobDir, name)
+
+def fetch_compress_to_scratch(url, cacheKey, ydl_opts, target_size):
+    '''
+    Runs fetch_compress_video in a new scratch directory & stores the result in the video cache
+    Returns the path of the compressed video (the scratch directory must be removed once it's used) or False
+    '''
+    jobDir = scratchSpace.create_job_dir()
+    try:
+        video_full_path = os.path.join(jobDir, "video")
+        compress_output = fetch_compress_video(url, dict(ydl_opts, outtmpl=video_full_path+".mp4"), video_full_path, target_size)
+        if not compress_output:
+            scratchSpace.remove(jobDir)
+            return False
+        try:
+            videoCache.put(cacheKey, compress_output)
+        except OSError as e:
+            log_event("WARNING","Failed to cache video: "+str(e))
     except:
+        scratchSpace.remove(jobDir)
+        raise
+    return compress_output
+
+def fetch_compress_cached_video(url, cacheKey, ydl_opts, name, target_size):
+    '''
+    Returns a VideoResult for a freshly downloaded & compressed video, or False
+    '''
+    compress_output = fetch_compress_to_scratch(url, cacheKey, ydl_opts, target_size)
+    if not compress_output:
         return False
+    return scratch_video_result(compress_output, name)
+
+def scratch_video_result(path, name):
+    try:
+        result = load_video_result(path, name)
+    except:
+        scratchSpace.remove(os.path.dirname(path))
+        raise
+    if result.data is not None:
+        # Held in memory, the scratch directory isn't needed anymore
+        scratchSpace.remove(os.path.dirname(path))
+    return result
+
+def build_ydl_opts(domain, targetSize, duration):
+    ydlOpts = dict(DEFAULT_YDL_OPTS)
+    ydlOpts['format'] = select_video_format(targetSize * 1000, duration)
+    ydlOpts.update(rules.ydl_opts_for(domain))
+    return ydlOpts
+
+def fetch_remote_video(url, cacheKey, domain, duration, name, targetSize):
+    '''
+    Hands a video job to the media workers & waits for it, returns a VideoResult or False
+    '''
+    jobId = mediaQueue.submit(url, cacheKey, name, targetSize, domain, duration, time.time()+VIDEO_JOB_TIMEOUT)
+    path = mediaQueue.wait(jobId, time.time()+VIDEO_JOB_TIMEOUT)
+    if not path:
+        return False
+    return scratch_video_result(path, name)
+
+def run_media_job(job):
+    '''
+    Runs a claimed media queue job, returns the path of the video in scratch space or False
+    '''
+    jobId, url, cacheKey, name, targetSize, domain, duration = job
+    cachePath = videoCache.get(cacheKey)
+    if cachePath:
+        try:
+            return link_cached_video(cachePath, name)
+        except FileNotFoundError:
+            videoCache.discard(cacheKey)
+    return fetch_compress_to_scratch(url, cacheKey, build_ydl_opts(domain, targetSize, duration), targetSize)
+
+def media_worker_loop(worker):
+    while True:
+        job = mediaQueue.claim(worker)
+        if not job:
+            time.sleep(MEDIA_QUEUE_POLL_INTERVAL)
+            continue
+        try:
+            path = run_media_job(job)
+        except Exception as e:
+            log_event("ERROR","Failed to download "+job[1]+": "+str(e))
+            mediaQueue.finish(job[0], error=str(e) or type(e).__name__)
+            continue
+        if path:
+            # The gateway removes the directory once it's uploaded
+            scratchSpace.hand_off(os.path.dirname(path))
+        if not mediaQueue.finish(job[0], path=path or None) and path:
+            scratchSpace.remove(os.path.dirname(path))
+
+def run_media_worker():
+    '''
+    Media worker process (python main.py worker), downloads & compresses videos queued in MEDIA_QUEUE_DB
+    Runs VIDEO_WORKERS jobs at once, RULES_FILE changes are picked up like on the gateway (download options come from it)
+    '''
+    if not mediaQueue:
+        sys.exit("MEDIA_QUEUE_DB must be set to run a media worker")
+    worker = socket.gethostname()+":"+str(os.getpid())
+    scratchSpace.sweep(SCRATCH_MAX_AGE)
+    log_event("INFO","Media worker "+worker+" started")
+    with ThreadPoolExecutor(max_workers=VIDEO_WORKERS, thread_name_prefix="media") as pool:
+        futures = [pool.submit(media_worker_loop, worker) for _ in range(VIDEO_WORKERS)]
+        while True:
+            done, pending = concurrent.futures.wait(futures, timeout=RULES_RELOAD_INTERVAL, return_when=FIRST_EXCEPTION)
+            for future in done:
+                # The loops only return by raising
+                future.result()
+            reload_rules()
+
+def normalize_video_url(parsedURL):
+    '''
+    Returns the key used to cache video probes (lowercase scheme & host, no fragment)
+    '''
+    normalizedURL = parsedURL.scheme.lower()+"://"+parsedURL.fqdn+"/"+parsedURL.path
+    if parsedURL.query:
+        normalizedURL += "?"+parsedURL.query
+    return normalizedURL
+
+@metrics.timed("probe")
+def extract_video_probe(url):
+    '''
+    Runs a yt-dlp extraction (no download) & summarizes the chosen format
+    Returns NOT_A_VIDEO only when the extractor reports there's no video, PROBE_FAILED for any other error
+    '''
+    yt_dlp = load_yt_dlp()
+    try:
+        with yt_dlp.YoutubeDL({"simulate": True, "format": "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4] / bv*+ba/b", "socket_timeout": VIDEO_PROBE_TIMEOUT}) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        error = e.exc_info[1] if e.exc_info else e
+        # Network errors & rate limits (429) are ExtractorErrors caused by a RequestError
+        if isinstance(error, yt_dlp.utils.ExtractorError) and error.expected and not isinstance(error.cause, yt_dlp.networking.exceptions.RequestError):
+            return NOT_A_VIDEO
+        return PROBE_FAILED
+    except Exception:
+        return PROBE_FAILED
+    if not info:
+        return NOT_A_VIDEO
+    if info.get("entries"):
+        # Playlists (e.g. ifunny) only use the first entry
+        info = next(iter(info["entries"]), None) or info
+    formats = info.get("requested_formats") or [info]
+    # Same estimate select_video_format uses, so allocate_video_budgets' budgets match what the selector picks
+    filesize = sum(estimate_format_size(videoFormat, info.get("duration")) or 0 for videoFormat in formats)
+    return {
+        "isVideo": True,
+        "duration": info.get("duration"),
+        "filesize": int(filesize) or None,
+        "format": info.get("format_id")
+    }
+
+async def run_video_probe(url, key):
+    '''
+    Runs extract_video_probe on the probe executor with a timeout & caches the result (failed probes aren't cached)
+    Timing out (or being cancelled) drops the probe if it hasn't started yet
+    '''
+    try:
+        probe = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(probeExecutor, extract_video_probe, url), VIDEO_PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        log_event("WARNING","Video probe timed out for "+url)
+        probe = PROBE_FAILED
+    finally:
+        del inFlightProbes[key]
+    if probe is not PROBE_FAILED:
+        probeCache.set(key, probe, negative=not probe["isVideo"])
+    return probe
+
+async def test_url_for_video(url,parsedURL):
+    '''
+    Probes URL for a video, returns a dict with isVideo, duration, filesize (estimated, bytes) & format
+    Results are cached & concurrent probes of the same URL share a single extraction
+    '''
+    if not rules.may_be_video(parsedURL):
+        return NOT_A_VIDEO
+    key = normalize_video_url(parsedURL)
+    probe = probeCache.get(key)
+    if probe is not CACHE_MISS:
+        return probe
+    if key not in inFlightProbes:
+        inFlightProbes[key] = asyncio.create_task(run_video_probe(url, key))
+    return await asyncio.shield(inFlightProbes[key])
 
 async def download_videos(urls, message, interaction):
+    '''
+    Downloads the provided AnalyzedURLs (already probed as videos) in parallel through the video scheduler
+    Returns VideoResults, which must be released with videoScheduler.release once sent
+    '''
+    if message:
+        channel = message.channel
+        outputPrefix = str(message.id)
+    else:
+        channel = interaction.channel
+        outputPrefix = "video-"+str(interaction.id)
+    guild = getattr(channel, "guild", None)
+    targetSizes = allocate_video_budgets(urls, get_upload_limit(channel))
+    results = [None]*len(urls)
+    jobs = {}
+    loop = asyncio.get_running_loop()
+    for index, url in enumerate(urls):
+        targetSize = targetSizes[index]
+        outputName = outputPrefix+"-"+str(index)+".mp4"
+        canonicalURL = normalize_video_url(url.parsedURL)
+        cacheKey = VideoCache.key_for(canonicalURL, targetSize)
+        # Reposted videos are sent straight from the cache (reading & linking it is disk I/O, kept off the event loop)
+        try:
+            results[index] = await loop.run_in_executor(None, fetch_cached_video, cacheKey, outputName)
+        except (OSError, ScratchFullError) as e:
+            results[index] = e
+        if results[index]:
+            continue
+        if await loop.run_in_executor(None, scratchSpace.is_full):
+            scratchSpace.rejected += 1
+            results[index] = ScratchFullError("Scratch space is full")
+            continue
+        duration = url.probe["duration"] if url.probe else None
+        if mediaQueue:
+            jobs[index] = videoScheduler.submit((canonicalURL, targetSize), guild.id if guild else None, fetch_remote_video, url.cleanURL, cacheKey, url.parsedURL.domain, duration, outputName, targetSize)
+        else:
+            ydlOpts = build_ydl_opts(url.parsedURL.domain, targetSize, duration)
+            jobs[index] = videoScheduler.submit((canonicalURL, targetSize), guild.id if guild else None, fetch_compress_cached_video, url.cleanURL, cacheKey, ydlOpts, outputName, targetSize)
+    if jobs:
+        async with channel.typing():
+            for index, result in zip(jobs, await asyncio.gather(*jobs.values(), return_exceptions=True)):
+                results[index] = result
     vidFiles = []
-    for url in urls:
-        parsedURL = parse_url(url)
-        if parsedURL:
-            if test_url_for_video(url, parsedURL):
-                if message:
-                    outputFile = str(message.id)+"-"+str(urls.index(url))
-                    channel = message.channel
-                else:
-                    outputFile = "video"
-                    channel = interaction.channel
-                ydlOutput = {'outtmpl': outputFile+".mp4"}
-                ydlDomainOpts = {}
-                for key in DOMAIN_YDL_OPTS:
-                    if key == parsedURL["domain"]:
-                        ydlDomainOpts = DOMAIN_YDL_OPTS[key]
-                try:
-                    async with timeout(60):
-                        vidFiles.append(await fetch_thread(channel, fetch_compress_video, url, dict(list(ydlOutput.items()) + list(DEFAULT_YDL_OPTS.items()) + list(ydlDomainOpts.items())), outputFile, False, len(urls)))
-                except asyncio.TimeoutError:
-                    break
+    for url, result in zip(urls, results):
+        if isinstance(result, asyncio.TimeoutError):
+            log_event("WARNING","Timed out downloading "+url.cleanURL)
+        elif isinstance(result, BaseException):
+            log_event("ERROR","Failed to download "+url.cleanURL+": "+str(result))
+        elif result:
+            vidFiles.append(result)
     if len(vidFiles):
         return vidFiles
     else:
         return False
 
-async def test_message_for_videos(message):
-    urls = clean_message(message,True)
-    for url in urls:
-        parsedURL = parse_url(url)
-        if parsedURL:
-            if test_url_for_video(url, parsedURL):
-                return True
-    return False
-
 # Sends updated message
+async def send_webhook_message(webhook, message, newMsg, vidFiles):
+    if vidFiles:
+        files = [vid.to_file() for vid in vidFiles if vid]
+        return await webhook.send(content=newMsg, files=files, username=message.author.display_name, avatar_url=message.author.display_avatar.url, wait=True, suppress_embeds=True)
+    return await webhook.send(content=newMsg, username=message.author.display_name, avatar_url=message.author.display_avatar.url, wait=True)
+
 async def send_message(message, newMsg, vidFiles):
     try:
-        # Channels
-        if not message.channel.id in webhooks:
-            ### Clears old webhooks from the bot ###
-            channel_webhooks = await message.channel.webhooks() 
-            for w in channel_webhooks:
-                if w.name == "LinkCleaner2":
-                    await w.delete()
-            ### END Clears old webhooks from the bot ###
-            webhooks[message.channel.id] = await message.channel.create_webhook(name="LinkCleaner2")
-            BLACKLISTED_USERS.append(str(webhooks[message.channel.id].id))
-
-        files = []
-        if vidFiles:
-            for vid in vidFiles:
-                if vid:
-                    files.append(discord.File("./"+vid))
-
-            tmpMessage = await webhooks[message.channel.id].send(content=newMsg, files=files, username=message.author.display_name, avatar_url=message.author.display_avatar.url, wait=True, suppress_embeds=True)
-
-            for vid in vidFiles:
-                if vid:
-                    os.remove("./"+vid)
-        else:
-            tmpMessage = await webhooks[message.channel.id].send(content=newMsg, username=message.author.display_name, avatar_url=message.author.display_avatar.url, wait=True)
-        return tmpMessage
-    except AttributeError:
-        # DMs
-        files = []
-        if vidFiles:
-            for vid in vidFiles:
-                if vid:
-                    files.append(discord.File("./"+vid))
-            newMessage = await message.channel.send(files=files)
-            for vid in vidFiles:
-                if vid:
-                    os.remove("./"+vid)
+        try:
+            # Channels
+            webhook = await webhookRegistry.get(message.channel)
+        except AttributeError:
+            # DMs
+            if vidFiles:
+                files = [vid.to_file() for vid in vidFiles if vid]
+                await message.channel.send(files=files)
+            return
+        try:
+            with metrics.timer("upload" if vidFiles else "webhook_send"):
+                return await send_webhook_message(webhook, message, newMsg, vidFiles)
+        except discord.NotFound:
+            # Webhook was deleted since it was stored, replace it & retry once
+            webhookRegistry.invalidate(message.channel.id, webhook)
+            webhook = await webhookRegistry.get(message.channel)
+            return await send_webhook_message(webhook, message, newMsg, vidFiles)
+    finally:
+        for vid in vidFiles or ():
+            if vid:
+                videoScheduler.release(vid)
 
 # Extracts youtube video IDs from parsedURL
 def extract_youtube_vid_id(parsedURL):
     try:
-        vidID = parsedURL["params"]["v"]
+        vidID = parsedURL.params["v"]
     except:
         # Not using params
-        pathParts = parsedURL["path"].split("/")
+        pathParts = parsedURL.path.split("/")
         for part in pathParts:
             if len(part) < 13 and len(part) > 9:
                 if part.isalnum():
@@ -448,19 +2288,21 @@ def extract_youtube_vid_id(parsedURL):
 # Clean command (Cleans links and replies ephemerally)
 @tree.command(name = "clean", description = "Cleans links")
 async def clean(interaction, link: str):
-    cleanedURL = clean_url(link)
+    analysis = await analyze_message(link)
+    cleanedURL = analysis.urls[0].cleanURL if analysis.urls else False
     await interaction.response.send_message(cleanedURL, ephemeral=True)
 
 # Attempts to Download video from provided URL
 @tree.command(name = "download", description = "Attempts to Download video from provided URL")
 async def download(interaction, link: str):
     await interaction.response.send_message("Attempting Download", ephemeral=True)
-    parsedURL = parse_url(link)
-    if test_url_for_video(link,parsedURL):
-        vidFiles = await download_videos([link], False, interaction)
+    analysis = await (await analyze_message(link, clean=False)).probe_videos()
+    vidURLs = analysis.video_urls()
+    if vidURLs:
+        vidFiles = await download_videos(vidURLs[:1], False, interaction)
         if vidFiles:
-            await interaction.channel.send(file=discord.File("./"+vidFiles[0]))
-            os.remove("./"+vidFiles[0])
+            await interaction.channel.send(file=vidFiles[0].to_file())
+            videoScheduler.release(vidFiles[0])
 
 ##############
 ### EVENTS ###
@@ -470,70 +2312,81 @@ async def download(interaction, link: str):
 async def on_message(message):
     if str(message.author.id) not in BLACKLISTED_USERS and str(message.channel.id) not in BLACKLISTED_CHANNELS:
         if "http://" in message.content or "https://" in message.content:
-            cleanedMessage = clean_message(message,False)
-            extractedURLs = clean_message(message,True)
-            containsVideos = await test_message_for_videos(message)
+            messageStart = time.perf_counter()
+            analysis = await analyze_message(message.content)
+            # Probe for videos in the background while the cleaned message is posted
+            probeTask = asyncio.create_task(analysis.probe_videos())
             reactions = []
             newMessage = False
-            if cleanedMessage:
-                newMessage = await send_message(message, cleanedMessage, False)
-                await message.delete()
-                if containsVideos:
-                    vidURLs = []
-                    for url in extractedURLs:
-                        if parse_url(url)["domain"] in AUTO_DOWNLOAD_VIDEO_DOMAINS:
-                            vidURLs.append(url)
-                        if parse_url(url)["domain"] in ["youtube"]:
-                            if '➡️' not in reactions:
-                                reactions.append('➡️')
-                    if vidURLs:
-                        vidFiles = await download_videos(vidURLs, message, False)
-                        await send_message(message, cleanedMessage, vidFiles)
-                        await message.delete()
-                    else:
-                        reactions.append('💾')
-            elif containsVideos:
-                vidURLs = []
-                for url in extractedURLs:
-                    if parse_url(url)["domain"] in AUTO_DOWNLOAD_VIDEO_DOMAINS:
-                        vidURLs.append(url)
-                    if parse_url(url)["domain"] in ["youtube"]:
-                        if '➡️' not in reactions:
-                            reactions.append('➡️')
-                if vidURLs:
-                    vidFiles = await download_videos(vidURLs, message, False)
-                    await send_message(message, message.content, vidFiles)
-                    await message.delete()
+            # Messages that may get videos attached are posted once, with the videos, instead of posted & reposted
+            autoDownload = any(url.parsedURL and url.parsedURL.domain in rules.autoDownloadVideoDomains for url in analysis.urls)
+            if analysis.newContent and not autoDownload:
+                newMessage = await actionQueue.send(message, analysis.newContent, False)
+                await actionQueue.delete(message)
+            await probeTask
+            if analysis.containsVideos:
+                if analysis.urls_for_domain("youtube"):
+                    reactions.append('➡️')
+                vidURLs = analysis.video_urls(rules.autoDownloadVideoDomains)
+                vidFiles = await download_videos(vidURLs, message, False) if vidURLs else False
+                if vidFiles:
+                    newMessage = await actionQueue.send(message, analysis.newContent or message.content, vidFiles)
+                    await actionQueue.delete(message)
                 else:
                     reactions.append('💾')
-            for emoji in reactions:
-                if newMessage:
-                    await newMessage.add_reaction(emoji)
-                else:
-                    await message.add_reaction(emoji)
+            if analysis.newContent and not newMessage:
+                newMessage = await actionQueue.send(message, analysis.newContent, False)
+                await actionQueue.delete(message)
+            await asyncio.gather(*[actionQueue.react(newMessage or message, emoji) for emoji in reactions])
+            metrics.observe("message", time.perf_counter()-messageStart)
+    record_first_message()
+
+async def get_message(channelId, messageId):
+    '''
+    Returns a message from the message cache, only fetching it from Discord on a miss
+    '''
+    for message in reversed(client.cached_messages):
+        if message.id == messageId:
+            return message
+    channel = client.get_channel(channelId) or client.get_partial_messageable(channelId)
+    return await channel.fetch_message(messageId)
+
+async def handle_reaction(message, emoji):
+    if emoji == '💾':
+        analysis = await (await analyze_message(message.content)).probe_videos()
+        vidURLs = analysis.video_urls()
+        if vidURLs:
+            vidFiles = await download_videos(vidURLs, message, False)
+            await actionQueue.send(message, message.content, vidFiles)
+            await actionQueue.delete(message)
+    elif emoji == '➡️':
+        analysis = await analyze_message(message.content)
+        for url in analysis.urls_for_domain("youtube"):
+            vidID = extract_youtube_vid_id(url.parsedURL)
+            await actionQueue.send(message, "https://"+INVIDIOUS_FQDN+"/embed/"+vidID+"?raw=1&quality=medium", False)
+            await actionQueue.edit(message, suppress=True)
 
+# Raw events fire for uncached messages too, the message is only looked up for reactions the bot acts on
 @client.event
-async def on_reaction_add(reaction, user):
-    if str(user.id) not in BLACKLISTED_USERS and str(reaction.message.channel.id) not in BLACKLISTED_CHANNELS:
-        if reaction.emoji == '💾':
-            containsVideos = await test_message_for_videos(reaction.message)
-            extractedURLs = clean_message(reaction.message,True)
-            if containsVideos:
-                vidURLs = []
-                for url in extractedURLs:
-                    vidURLs.append(url)
-                if vidURLs:
-                    vidFiles = await download_videos(vidURLs, reaction.message, False)
-                    await send_message(reaction.message, reaction.message.content, vidFiles)
-                    await reaction.message.delete()
-        elif reaction.emoji == '➡️':
-            extractedURLs = clean_message(reaction.message,True)
-            for url in extractedURLs:
-                parsedURL = parse_url(url)
-                if parsedURL["domain"] == "youtube":
-                    vidID = extract_youtube_vid_id(parsedURL)
-                    await send_message(reaction.message, "https://"+INVIDIOUS_FQDN+"/embed/"+vidID+"?raw=1&quality=medium", False)
-                    await reaction.message.edit(suppress=True)
+async def on_raw_reaction_add(payload):
+    emoji = str(payload.emoji)
+    if emoji not in ('💾', '➡️') or payload.user_id == client.user.id:
+        return
+    if str(payload.user_id) not in BLACKLISTED_USERS and str(payload.channel_id) not in BLACKLISTED_CHANNELS:
+        # Everyone reacting to the same message shares one job
+        jobKey = (payload.message_id, emoji)
+        if jobKey in reactionJobs:
+            return
+        reactionJobs.add(jobKey)
+        try:
+            try:
+                message = await get_message(payload.channel_id, payload.message_id)
+            except discord.NotFound:
+                # Already replaced by a repost
+                return
+            await handle_reaction(message, emoji)
+        finally:
+            reactionJobs.discard(jobKey)
 
 
 ##############
@@ -543,5 +2396,27 @@ async def on_reaction_add(reaction, user):
 @client.event
 async def on_ready():
     await client.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='Waiting for links'))
-    await tree.sync()
-client.run(TOKEN)
+    if "stats" not in backgroundTasks:
+        backgroundTasks["stats"] = asyncio.create_task(log_stats())
+    if "sweepScratch" not in backgroundTasks:
+        backgroundTasks["sweepScratch"] = asyncio.create_task(sweep_scratch())
+    if "watchRules" not in backgroundTasks:
+        backgroundTasks["watchRules"] = asyncio.create_task(watch_rules())
+    if METRICS_PORT and "metrics" not in backgroundTasks:
+        backgroundTasks["metrics"] = asyncio.create_task(serve_metrics())
+    if WEBHOOK_PREWARM and "prewarmWebhooks" not in backgroundTasks:
+        backgroundTasks["prewarmWebhooks"] = asyncio.create_task(webhookRegistry.prewarm())
+    if "syncCommands" not in backgroundTasks:
+        # on_ready fires again on every reconnect, startup is only reported & commands only synced once
+        readySeconds = time.monotonic()-bootTime
+        metrics.set_gauge("startup ready seconds", readySeconds)
+        log_event("INFO","Connected "+format(readySeconds, ".2f")+"s after startup")
+        backgroundTasks["syncCommands"] = asyncio.create_task(sync_commands())
+    if MEDIA_WARMUP and "warmMedia" not in backgroundTasks:
+        backgroundTasks["warmMedia"] = asyncio.create_task(warm_up_media())
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["worker"]:
+        run_media_worker()
+    else:
+        client.run(TOKEN)
@@ -0,0 +1,186 @@
+'''
+Micro-benchmark comparing parse_url against the original string-slicing parser
+
+Usage: python benchmarks/bench_parse_url.py [iterations]
+'''
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+SCRATCH = tempfile.mkdtemp(prefix="linkcleaner-bench-")
+
+# main.py reads these at import time, keep every cache in memory/temp instead of the working directory
+for variable, value in {
+    "BLACKLISTED_USERS": "",
+    "BLACKLISTED_CHANNELS": "",
+    "VIDEO_PROBE_CACHE_DB": ":memory:",
+    "WEBHOOK_DB": "",
+    "VIDEO_CACHE_SIZE_MB": "0",
+    "SCRATCH_DIR": os.path.join(SCRATCH, "scratch"),
+    "VIDEO_CACHE_DIR": os.path.join(SCRATCH, "video_cache")
+}.items():
+    os.environ.setdefault(variable, value)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LinkCleaner"))
+
+import main
+
+URLS = [
+    "https://www.example.com/testpage?test=yes#completed",
+    "https://x.com/someone/status/1234567890123456789?s=20&t=abcdef",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abcdefgh",
+    "https://youtu.be/dQw4w9WgXcQ?si=abcdefgh",
+    "https://www.reddit.com/r/videos/comments/abc123/some_title/?utm_source=share&utm_medium=web2x",
+    "https://www.bbc.co.uk/news/articles/c0000000000o",
+    "https://www.abc.net.au/news/2024-01-01/story/100000000",
+    "https://example.com.au/shop?item=1",
+    "https://someone.github.io/project/",
+    "https://cdn.discordapp.com/attachments/1/2/image.png?ex=1&is=2&hm=3",
+    "https://media.tenor.com/abcdef/tenor.gif",
+    "https://ifunny.co/video/abcdef",
+    "https://www.tiktok.com/@user/video/1234567890",
+    "https://minecraft.fandom.com/wiki/Creeper",
+]
+
+def log_event(level, event):
+    pass
+
+def legacy_parse_url(url):
+    '''
+    Splits a URL into it's components
+
+    https ://   www    . example . com / testpage ? test=yes # completed
+    └─┰─┘      └─┰─┘     └──┰──┘   └┰┘   └──┰───┘   └──┰───┘   └───┰───┘
+    scheme | subdomain | domain  | tld |   path   |  params  |  fragment
+             └───────────┰───────────┘
+         fully qualified domain name (fqdn)
+    '''
+
+    # Basic validation check
+    if url.count(' ') > 0:
+        # Reject URLs with spaces
+        log_event("ERROR","URL provided is invalid (contains spaces)")
+        return False
+
+    # Extract Scheme
+    if url.count('://') == 1:
+        scheme = url[0:url.find('://')]
+    else:
+        # Return False for invalid URLs
+        log_event("ERROR","URL provided is invalid")
+        return False
+
+    # Extract combined (subdoamin), domain, tld
+
+    seperatorPosDict = {}
+    for seperator in ('/','?','#'):
+        seperatorPosDict[seperator] = url[len(scheme)+3:].find(seperator)
+    # Set netLocation (combined subdomain, domain, tld) by finding position of first
+    netLocation = url[len(scheme)+3:min(i for i in (seperatorPosDict["/"],seperatorPosDict["?"],seperatorPosDict["#"],len(url)-len(scheme)-3) if i > 0)+len(scheme)+3]
+
+    # Extract TLD
+    if netLocation.count('.') > 1:
+        # Check if TLD is country code (.co.xx)
+        if netLocation[netLocation.rfind('.')-2:netLocation.rfind('.')] == 'co':
+            # TLD is country code
+            tld = netLocation[netLocation.rfind('.')-2:]
+        else:
+            # TLD is not country code
+            tld = netLocation[netLocation.rfind('.')+1:]
+    else:
+        # TLD cannot be country code
+        tld = netLocation[netLocation.find('.')+1:]
+
+    # Extract subdomain (if exists)
+    if netLocation[0:netLocation.rfind(tld)-1].count('.') > 0:
+        subdomain = netLocation[0:netLocation[0:netLocation.rfind(tld)-1].rfind('.')]
+    else:
+        # No subdomain
+        subdomain = ''
+
+    # Extract what's left of the domain
+    if len(subdomain) > 0:
+        # If subdomain exists remove period
+        domain = netLocation[len(subdomain)+1:netLocation.rfind(tld)-1]
+    else:
+        # Else it's not needed
+        domain = netLocation[:netLocation.rfind(tld)-1]
+
+    # Extract Path
+    if seperatorPosDict["/"] > 0:
+        if seperatorPosDict["#"] > 0 or seperatorPosDict["?"] > 0:
+            # path ends at params/fragment
+            path = url[seperatorPosDict["/"]+len(scheme)+4:min(i for i in (seperatorPosDict["?"],seperatorPosDict["#"]) if i > 0)+len(scheme)+3]
+        else:
+            # No params/fragment
+            path = url[seperatorPosDict["/"]+len(scheme)+4:]
+    else:
+        # No path
+        path = ''
+
+    # Extract params & fragment
+    if seperatorPosDict["?"] > 0:
+        if seperatorPosDict["#"] > 0 and seperatorPosDict["#"] > seperatorPosDict["?"]:
+            # fragment present
+            fragment = url[seperatorPosDict["#"]+len(scheme)+4:]
+            params = url[seperatorPosDict["?"]+len(scheme)+4:seperatorPosDict["#"]+len(scheme)+3]
+        else:
+            # No fragment, catch edge case of # before
+            fragment = ''
+            params = url[seperatorPosDict["?"]+len(scheme)+4:]
+    elif seperatorPosDict["#"] > 0:
+        # No params but fragment
+        fragment = url[seperatorPosDict["#"]+len(scheme)+4:]
+        params = ''
+    else:
+        # No params or fragment
+        fragment = ''
+        params = ''
+
+    # Break params into dict
+    paramsDict = {}
+    if params:
+        for param in params.split("&"):
+            if param.count("=") == 1:
+                paramsDict[param.split("=")[0]] = param.split("=")[1]
+            else:
+                # Malformed params
+                log_event("WARNING","URL contains malformed parameters")
+
+    parsedURL = {
+        "scheme": scheme,
+        "fqdn": netLocation,
+        "subdomain": subdomain,
+        "domain": domain,
+        "tld": tld,
+        "path": path,
+        "params": paramsDict,
+        "fragment": fragment
+    }
+
+    return parsedURL
+
+def run(name, function, iterations):
+    seconds = timeit.timeit(lambda: [function(url) for url in URLS], number=iterations)
+    perCall = seconds / (iterations * len(URLS)) * 1e6
+    print(f"{name:<24} {perCall:8.2f} us/call")
+    return perCall
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    main.log_event = log_event
+    main.get_public_suffix_trie()
+
+    legacy = run("legacy parse_url", legacy_parse_url, iterations)
+    uncached = run("parse_url (no memo)", main.parse_url.__wrapped__, iterations)
+    cached = run("parse_url (memoized)", main.parse_url, iterations)
+    print(f"speedup: {legacy/uncached:.1f}x uncached, {legacy/cached:.1f}x memoized")
+
+    print()
+    print("domain differences (legacy -> parse_url):")
+    for url in URLS:
+        old, new = legacy_parse_url(url), main.parse_url(url)
+        if old["domain"] != new.domain or old["tld"] != new.tld:
+            print(f"  {url}: {old['domain']}.{old['tld']} -> {new.domain}.{new.tld}")
+    shutil.rmtree(SCRATCH, ignore_errors=True)
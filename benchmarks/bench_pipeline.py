@@ -0,0 +1,405 @@
+'''
+Offline load test replaying a corpus of messages through analyze_message & on_message
+
+Everything the bot talks to is replaced by local stand-ins:
+ - Discord: fake channels, messages & webhooks (optionally with a simulated API latency)
+ - Redirects: every hostname resolves to a local HTTP server serving redirect chains, slow hosts & hosts rejecting HEAD
+ - yt-dlp & ffmpeg: stubs that sleep for a while & write a small fixture video
+
+Reports throughput, p50/p99 latency & peak RSS, exits with 1 if a result regressed against the baseline
+
+Usage: python benchmarks/bench_pipeline.py [--messages N] [--concurrency N] [--runs N] [--corpus messages.jsonl]
+                                           [--baseline benchmarks/baseline.json] [--tolerance 0.25] [--update-baseline]
+'''
+import os
+import sys
+import json
+import time
+import random
+import statistics
+import socket
+import asyncio
+import argparse
+import shutil
+import zlib
+import tempfile
+import threading
+import resource
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRATCH = tempfile.mkdtemp(prefix="linkcleaner-bench-")
+
+# main.py reads these at import time, keep every cache in memory/temp & off the network
+for variable, value in {
+    "BLACKLISTED_USERS": "",
+    "BLACKLISTED_CHANNELS": "",
+    "VIDEO_PROBE_CACHE_DB": ":memory:",
+    "WEBHOOK_DB": "",
+    "VIDEO_CACHE_SIZE_MB": "0",
+    "SCRATCH_DIR": os.path.join(SCRATCH, "scratch"),
+    "VIDEO_CACHE_DIR": os.path.join(SCRATCH, "video_cache"),
+    "CACHE_STATS_INTERVAL": "86400"
+}.items():
+    os.environ.setdefault(variable, value)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "LinkCleaner"))
+
+import aiohttp
+from aiohttp import web
+import main
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+# Simulated work, in seconds
+PROBE_TIME = 0.005
+DOWNLOAD_TIME = 0.02
+FIXTURE_VIDEO_BYTES = 256*1024
+
+#####################
+### LOCAL SERVERS ###
+#####################
+
+async def handle_request(request):
+    '''
+    /chain/<hops>/<id>     redirects <hops> times on the same host, then to another domain
+    /slow/<ms>/<id>        waits <ms> before redirecting to another domain
+    /nohead/<id>           rejects HEAD (405), GET redirects to another domain
+    anything else          200
+    '''
+    parts = request.path.strip("/").split("/")
+    if parts[0] == "chain" and len(parts) == 3:
+        hops = int(parts[1])
+        if hops > 0:
+            raise web.HTTPFound("/chain/"+str(hops-1)+"/"+parts[2])
+    elif parts[0] == "slow" and len(parts) == 3:
+        await asyncio.sleep(int(parts[1])/1000)
+    elif parts[0] == "nohead" and len(parts) == 2:
+        if request.method == "HEAD":
+            raise web.HTTPMethodNotAllowed("HEAD", ["GET"])
+    else:
+        return web.Response(text="ok")
+    raise web.HTTPFound("http://www.example.com/article/"+parts[-1]+"?utm_source=bench&utm_medium=redirect")
+
+def start_redirect_server():
+    '''
+    Runs the redirect server on its own event loop & thread so it doesn't skew the pipeline's timings
+    Returns the port it listens on
+    '''
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    port = []
+
+    async def serve():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handle_request)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port.append(site._server.sockets[0].getsockname()[1])
+        ready.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return port[0]
+
+class LocalResolver(aiohttp.abc.AbstractResolver):
+    '''
+    Resolves every hostname to the local redirect server
+    '''
+    def __init__(self, port):
+        self.port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{"hostname": host, "host": "127.0.0.1", "port": self.port, "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+###############
+### DISCORD ###
+###############
+
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+class FakeUser:
+    def __init__(self, userId):
+        self.id = userId
+        self.display_name = "user"+str(userId)
+        self.display_avatar = FakeAsset()
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+class FakeGuild:
+    id = 1
+    filesize_limit = 10*1024*1024
+
+class FakeDiscord:
+    '''
+    Counts API calls, each one takes apiLatency seconds
+    '''
+    def __init__(self, apiLatency):
+        self.apiLatency = apiLatency
+        self.calls = {}
+        self.nextId = 10**15
+
+    async def call(self, name):
+        self.calls[name] = self.calls.get(name, 0)+1
+        if self.apiLatency:
+            await asyncio.sleep(self.apiLatency)
+
+    def new_id(self):
+        self.nextId += 1
+        return self.nextId
+
+class FakeWebhook:
+    name = "LinkCleaner2"
+    token = "token"
+
+    def __init__(self, discord, channel):
+        self.discord = discord
+        self.channel = channel
+        self.id = discord.new_id()
+
+    async def send(self, content=None, files=None, username=None, avatar_url=None, wait=False, suppress_embeds=False):
+        await self.discord.call("upload" if files else "webhook_send")
+        return FakeMessage(self.discord, self.channel, content, FakeUser(self.id))
+
+class FakeChannel:
+    guild = FakeGuild()
+
+    def __init__(self, discord, channelId):
+        self.discord = discord
+        self.id = channelId
+        self.hooks = []
+
+    def typing(self):
+        return FakeTyping()
+
+    async def webhooks(self):
+        await self.discord.call("webhooks")
+        return list(self.hooks)
+
+    async def create_webhook(self, name):
+        await self.discord.call("create_webhook")
+        self.hooks.append(FakeWebhook(self.discord, self))
+        return self.hooks[-1]
+
+class FakeMessage:
+    def __init__(self, discord, channel, content, author):
+        self.discord = discord
+        self.id = discord.new_id()
+        self.channel = channel
+        self.content = content
+        self.author = author
+
+    async def delete(self):
+        await self.discord.call("delete")
+
+    async def add_reaction(self, emoji):
+        await self.discord.call("react")
+
+    async def edit(self, **kwargs):
+        await self.discord.call("edit")
+
+#############
+### STUBS ###
+#############
+
+def stub_extract_video_probe(url):
+    time.sleep(PROBE_TIME)
+    return {"isVideo": True, "duration": 30, "filesize": 4*1024*1024, "format": "stub"}
+
+def stub_fetch_compress_video(url, ydl_opts, video_full_path, target_size):
+    time.sleep(DOWNLOAD_TIME)
+    output = video_full_path+"-compressed.mp4"
+    with open(output, "wb") as videoFile:
+        videoFile.write(os.urandom(FIXTURE_VIDEO_BYTES))
+    return output
+
+##############
+### CORPUS ###
+##############
+
+TEMPLATES = [
+    "lol",
+    "check this out {article}",
+    "{article} and {tenor}",
+    "{cdn}",
+    "{tenor}",
+    "{discord}",
+    "{youtube}",
+    "{twitter} 😂",
+    "{reddit_video}",
+    "{shortener}",
+    "{slow}",
+    "{nohead}",
+    "```\n{article}\n```",
+    "compare `{article}` with {cdn}",
+    "{twitter} {youtube} {article}",
+]
+
+def generate_corpus(count, seed=1):
+    '''
+    Deterministic mix of messages, URLs are partly reused (as in real channels) & partly unique
+    '''
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        unique = rng.randrange(max(1, count//4))
+        corpus.append(rng.choice(TEMPLATES).format(
+            article="https://www.example.com/article/"+str(unique)+"?utm_source=twitter&utm_campaign=x&id="+str(unique),
+            tenor="https://tenor.com/view/funny-cat-"+str(unique),
+            cdn="https://cdn.discordapp.com/attachments/1/"+str(unique)+"/image.png?ex=1&is=2&hm=3",
+            discord="https://discord.com/channels/1/2/"+str(unique),
+            youtube="https://www.youtube.com/watch?v=dQw4w9WgX"+str(unique % 100).zfill(2)+"&si=tracking",
+            twitter="https://twitter.com/someone/status/"+str(1000+unique)+"?s=20&t=abc",
+            reddit_video="https://www.reddit.com/r/videos/comments/"+str(unique)+"/title/?utm_source=share",
+            shortener="http://bit.ly/chain/2/"+str(unique),
+            slow="http://t.co/slow/50/"+str(unique),
+            nohead="http://tinyurl.com/nohead/"+str(unique)
+        ))
+    return corpus
+
+def load_corpus(path):
+    '''
+    Reads a JSON lines file with one message (string) per line
+    '''
+    with open(path, encoding="utf-8") as corpusFile:
+        return [json.loads(line) for line in corpusFile if line.strip()]
+
+#################
+### SCENARIOS ###
+#################
+
+def reset_caches():
+    main.urlCache.clear()
+    main.probeCache.clear()
+    main.parse_url.cache_clear()
+    main.clean_url_offline.cache_clear()
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues)-1, int(len(sortedValues)*fraction))]
+
+async def replay(corpus, concurrency, handler):
+    '''
+    Runs handler(content) for every message, at most concurrency at once, returns throughput & latency
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(content):
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(content)
+            latencies.append(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(content) for content in corpus])
+    wallTime = time.perf_counter()-start
+    latencies.sort()
+    return {
+        "throughput": len(corpus)/wallTime,
+        "p50": percentile(latencies, 0.50)*1000,
+        "p99": percentile(latencies, 0.99)*1000
+    }
+
+async def run_benchmarks(corpus, concurrency, apiLatency, runs):
+    '''
+    Runs every scenario runs times, returns the median of each result
+    '''
+    port = start_redirect_server()
+    main.httpSession = aiohttp.ClientSession(connector=aiohttp.TCPConnector(resolver=LocalResolver(port), limit=main.REDIRECT_POOL_SIZE), headers=main.REDIRECT_HEADERS)
+    discord = FakeDiscord(apiLatency)
+    channels = [FakeChannel(discord, channelId) for channelId in range(100, 108)]
+    author = FakeUser(42)
+    runResults = {}
+
+    async def clean(content):
+        await main.analyze_message(content)
+
+    async def on_message(content):
+        message = FakeMessage(discord, channels[zlib.crc32(content.encode()) % len(channels)], content, author)
+        await main.on_message(message)
+
+    for run in range(runs):
+        reset_caches()
+        runResults.setdefault("clean (cold)", []).append(await replay(corpus, concurrency, clean))
+        runResults.setdefault("clean (warm)", []).append(await replay(corpus, concurrency, clean))
+        reset_caches()
+        runResults.setdefault("on_message", []).append(await replay(corpus, concurrency, on_message))
+    await main.httpSession.close()
+    results = {scenario: {key: statistics.median(result[key] for result in scenarioResults) for key in scenarioResults[0]} for scenario, scenarioResults in runResults.items()}
+    results["peakRSSMB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    results["discordCalls"] = {name: count // runs for name, count in discord.calls.items()}
+    return results
+
+def compare(results, baseline, tolerance, latencySlack):
+    '''
+    Returns a list of regressions (throughput/latency/RSS more than tolerance worse than the baseline)
+    Latencies also get latencySlack ms of absolute slack, sub-millisecond percentiles are mostly scheduling noise
+    '''
+    regressions = []
+    for scenario, stats in results.items():
+        if not isinstance(stats, dict) or scenario not in baseline or scenario == "discordCalls":
+            continue
+        if stats["throughput"] < baseline[scenario]["throughput"]*(1-tolerance):
+            regressions.append(f"{scenario}: throughput {stats['throughput']:.0f}/s < baseline {baseline[scenario]['throughput']:.0f}/s")
+        for key in ("p50", "p99"):
+            if stats[key] > baseline[scenario][key]*(1+tolerance)+latencySlack:
+                regressions.append(f"{scenario}: {key} {stats[key]:.2f}ms > baseline {baseline[scenario][key]:.2f}ms")
+    if "peakRSSMB" in baseline and results["peakRSSMB"] > baseline["peakRSSMB"]*(1+tolerance):
+        regressions.append(f"peak RSS {results['peakRSSMB']:.0f}MB > baseline {baseline['peakRSSMB']:.0f}MB")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test for the message pipeline")
+    parser.add_argument("--messages", type=int, default=2000, help="number of generated messages")
+    parser.add_argument("--concurrency", type=int, default=32, help="messages handled at once")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds each fake Discord API call takes")
+    parser.add_argument("--corpus", help="JSON lines file of messages to replay instead of generated ones")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression (0.25 = 25%%)")
+    parser.add_argument("--latency-slack", type=float, default=10.0, help="ms of latency regression always allowed")
+    parser.add_argument("--runs", type=int, default=5, help="times each scenario is run (the median is reported)")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    args = parser.parse_args()
+
+    main.log_event = lambda level, event: None
+    main.extract_video_probe = stub_extract_video_probe
+    main.fetch_compress_video = stub_fetch_compress_video
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.messages)
+
+    try:
+        results = asyncio.run(run_benchmarks(corpus, args.concurrency, args.api_latency, args.runs))
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+    print(f"{len(corpus)} messages, concurrency {args.concurrency}, median of {args.runs} runs")
+    for scenario, stats in results.items():
+        if isinstance(stats, dict) and "throughput" in stats:
+            print(f"{scenario:<14} {stats['throughput']:10.0f} msg/s   p50 {stats['p50']:8.2f}ms   p99 {stats['p99']:8.2f}ms")
+    print(f"peak RSS {results['peakRSSMB']:.0f}MB")
+    print("discord calls: "+", ".join(name+"="+str(count) for name, count in sorted(results["discordCalls"].items())))
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baselineFile:
+            json.dump({key: value for key, value in results.items() if key != "discordCalls"}, baselineFile, indent=4)
+        print("baseline updated: "+args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as baselineFile:
+            regressions = compare(results, json.load(baselineFile), args.tolerance, args.latency_slack)
+        if regressions:
+            print("REGRESSIONS:")
+            for regression in regressions:
+                print("  "+regression)
+            sys.exit(1)
+        print("no regressions against "+args.baseline)